@@ -0,0 +1,240 @@
+"""
+Co-simulation of CPU.hdl and Memory.hdl against the instruction-level
+emulator. Both engines run the same ROM, and each cycle the PC, A and D
+the CPU starts from and the outM, writeM and addressM it drives are
+compared. With --every N only the PC, A, D and memory are compared, every
+N cycles; a mismatch rolls both engines back to the last checkpoint and
+replays those cycles one by one to find the first that went wrong.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), "6"))
+
+from emulator import SCREEN, Emulator, signed
+from hdl import DEFAULT_BUILTINS, MODES, loadChip
+from instrument import mnemonic
+
+FIELDS = ("PC", "A", "D", "addressM", "writeM", "outM", "next PC")
+# CPU pins read at the start of each cycle; A and D are CPU.hdl's own
+STATE_PINS = ("pc", "A", "D", "addressM")
+# Memory builtins and where they sit in the emulator's RAM
+MEMORY_BLOCKS = (("RAM16K", 0), ("Screen", SCREEN))
+
+
+class CoSimulation:
+    def __init__(self, program, cpupath, memorypath, builtins=None, mode="compiled"):
+        self.emulator = Emulator()
+        self.emulator.load(program)
+        self.rom = self.emulator.rom
+        self.cpu = loadChip(cpupath, builtins, mode)
+        self.memory = loadChip(memorypath, builtins, mode)
+        missing = [pin for pin in STATE_PINS if pin not in self.cpu.pins]
+        if missing:
+            raise ValueError(f"{cpupath} has no {', '.join(missing)} to compare")
+        self.cycles = 0
+        # Cycles each engine ran, including any replayed after a rollback
+        self.executed = 0
+        self.emulatorTime = 0.0
+        self.hdlTime = 0.0
+
+    def emulatorCycle(self):
+        """
+        Executes one instruction, returning the state it started from and
+        what the CPU should drive: outM is None for A-instructions.
+        """
+        emulator = self.emulator
+        pc, a, d = emulator.PC, emulator.A, emulator.D
+        ins = emulator.code[pc]
+        if ins.__class__ is int:
+            write, out = 0, None
+        else:
+            comp, usem, dest, _ = ins
+            out = comp(d, emulator.ram[a & 0x7FFF] if usem else a)
+            write = dest & 1
+        emulator.execute(1, ())
+        return pc, a, d, a & 0x7FFF, write, out, emulator.PC
+
+    def hdlCycle(self):
+        """One clock cycle of the HDL computer, Python playing the ROM."""
+        cpu = self.cpu
+        memory = self.memory
+        # The state pins come straight from registers: no full eval needed
+        cpu.eval(STATE_PINS)
+        pc, a, d, address = (cpu.get(pin) for pin in STATE_PINS)
+        memory.set("address", address)
+        memory.eval(("out",))
+        cpu.set("instruction", self.rom[pc] if pc < len(self.rom) else 0)
+        cpu.set("inM", memory.get("out"))
+        cpu.tick()
+        out = cpu.get("outM")
+        write = cpu.get("writeM")
+        memory.set("in", out)
+        memory.set("load", write)
+        memory.tick()
+        memory.tock(settle=False)
+        cpu.tock(settle=False)
+        cpu.eval(("pc",))
+        return pc, a, d, address, write, out, cpu.get("pc")
+
+    def step(self):
+        """Runs one cycle on both engines, returning the fields that differ."""
+        start = time.perf_counter()
+        expected = self.emulatorCycle()
+        middle = time.perf_counter()
+        actual = self.hdlCycle()
+        self.hdlTime += time.perf_counter() - middle
+        self.emulatorTime += middle - start
+        self.cycles += 1
+        self.executed += 1
+        return [
+            (name, e, a)
+            for name, e, a in zip(FIELDS, expected, actual)
+            if e is not None and e != a
+        ]
+
+    def advance(self, cycles, stops):
+        """Runs both engines without comparing, the emulator at full speed."""
+        start = time.perf_counter()
+        n = self.emulator.execute(cycles, stops)
+        middle = time.perf_counter()
+        for _ in range(n):
+            self.hdlCycle()
+        self.hdlTime += time.perf_counter() - middle
+        self.emulatorTime += middle - start
+        self.cycles += n
+        self.executed += n
+        return n
+
+    def differences(self):
+        """Compares the state both engines are in: PC, A, D and memory."""
+        emulator = self.emulator
+        cpu = self.cpu
+        cpu.eval(STATE_PINS)
+        found = [
+            (name, e, cpu.get(pin))
+            for name, pin, e in zip(FIELDS, STATE_PINS, (emulator.PC, emulator.A, emulator.D))
+            if e != cpu.get(pin)
+        ]
+        ram = emulator.ram
+        for name, base in MEMORY_BLOCKS:
+            try:
+                memory = self.memory.block(name).memory
+            except ValueError:
+                continue
+            if memory != ram[base : base + len(memory)]:
+                i = next(i for i, value in enumerate(memory) if ram[base + i] != value)
+                found.append((f"RAM[{base + i}]", ram[base + i], memory[i]))
+        return found
+
+    def checkpoint(self):
+        # Snapshots are taken with nothing left to propagate
+        self.cpu.eval()
+        self.memory.eval()
+        return (
+            self.emulator.snapshot(),
+            self.cpu.snapshot(),
+            self.memory.snapshot(),
+            self.cycles,
+        )
+
+    def rollback(self, checkpoint):
+        blob, cpu, memory, self.cycles = checkpoint
+        self.emulator.restore(blob)
+        self.cpu.restore(cpu)
+        self.memory.restore(memory)
+
+    def run(self, cycles, every=1, stops=()):
+        """
+        Runs up to `cycles` cycles in all, stopping early when the
+        emulator's PC reaches one of `stops`. Returns None, or the first
+        mismatch as (cycle, PC, [(field, emulator value, HDL value)]).
+        """
+        emulator = self.emulator
+        while self.cycles < cycles and emulator.PC not in stops:
+            if every == 1:
+                pc = emulator.PC
+                found = self.step()
+                if found:
+                    return self.cycles - 1, pc, found
+                continue
+            checkpoint = self.checkpoint()
+            n = self.advance(min(every, cycles - self.cycles), stops)
+            found = self.differences()
+            if found:
+                self.rollback(checkpoint)
+                # Every difference in state starts with one in some cycle
+                return self.run(self.cycles + n, 1, stops) or (
+                    self.cycles,
+                    emulator.PC,
+                    found,
+                )
+        return None
+
+
+def formatValue(name, value):
+    if name in ("PC", "next PC", "addressM", "writeM"):
+        return str(value)
+    return str(signed(value))
+
+
+def rate(cycles, seconds):
+    return f"{cycles} cycles in {seconds:.2f}s ({cycles / max(seconds, 1e-9):,.0f} cycles/s)"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run a Hack program on CPU.hdl and Memory.hdl and on the emulator, "
+        "comparing them"
+    )
+    parser.add_argument("program", help="a .asm or .hack file")
+    parser.add_argument("cycles", nargs="?", type=int, default=100000)
+    parser.add_argument("--cpu", default=os.path.join(HERE, "CPU.hdl"))
+    parser.add_argument("--memory", default=os.path.join(HERE, "Memory.hdl"))
+    parser.add_argument("--mode", choices=MODES, default="compiled")
+    parser.add_argument(
+        "--every",
+        type=int,
+        default=1,
+        metavar="N",
+        help="compare the state every N cycles instead of the pins every cycle",
+    )
+    parser.add_argument(
+        "--builtin",
+        action="append",
+        metavar="CHIP",
+        help="use the Python version of a chip even where its .hdl exists",
+    )
+    args = parser.parse_args()
+    if args.every < 1:
+        parser.error("--every must be at least 1")
+    builtins = DEFAULT_BUILTINS | set(args.builtin or ())
+
+    try:
+        cosim = CoSimulation(args.program, args.cpu, args.memory, builtins, args.mode)
+    except ValueError as e:
+        parser.error(str(e))
+    mismatch = cosim.run(args.cycles, args.every, cosim.emulator.haltAddresses())
+
+    if mismatch is None:
+        print(f"no mismatch in {cosim.cycles} cycles")
+    else:
+        cycle, pc, found = mismatch
+        word = cosim.rom[pc] if pc < len(cosim.rom) else 0
+        print(f"mismatch at cycle {cycle}, PC={pc} ({mnemonic(word)})")
+        for name, expected, actual in found:
+            print(
+                f"  {name}: emulator {formatValue(name, expected)}, "
+                f"HDL {formatValue(name, actual)}"
+            )
+    print(f"emulator: {rate(cosim.executed, cosim.emulatorTime)}")
+    print(f"HDL ({args.mode}): {rate(cosim.executed, cosim.hdlTime)}")
+    sys.exit(0 if mismatch is None else 1)
+
+
+if __name__ == "__main__":
+    main()
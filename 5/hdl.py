@@ -0,0 +1,906 @@
+"""
+Simulator for the HDL chips of chapters 1-5. A chip is flattened into Nand
+gates, DFFs and builtin parts written in Python, then evaluated either in
+full, every gate in topological order, or event-driven: only the gates
+downstream of a changed input or DFF output are re-evaluated, level by
+level, through a precomputed fan-out index. The full evaluation can also
+be compiled into one generated Python function.
+"""
+
+import argparse
+from array import array
+import copy
+import os
+import re
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "6"))
+
+from tst import (
+    formatHeader,
+    formatValue,
+    matchesCompareFile,
+    parseOutputSpec,
+    parseScript,
+    stripComments,
+)
+
+TOKEN = re.compile(r"\.\.|[A-Za-z_][\w.]*|\d+|[{}()\[\];,=:]")
+VALUE = re.compile(r"^%([BXD])(.+)$")
+FALSE, TRUE = 0, 1
+MODES = ("event", "full", "compiled")
+
+# Chips flattening would turn into hundreds of thousands of gates
+DEFAULT_BUILTINS = {"RAM4K", "RAM16K", "ROM32K", "Screen", "Keyboard"}
+
+
+class ChipDefinition:
+    def __init__(self, name, inputs, outputs, parts, path=None):
+        self.name = name
+        # Pin name to width, in declaration order
+        self.inputs = inputs
+        self.outputs = outputs
+        # (part, [(pin, pin range, net, net range)]), a range being None
+        # for the whole bus or (first, last)
+        self.parts = parts
+        self.path = path
+
+    def pins(self):
+        return {**self.inputs, **self.outputs}
+
+
+def parseHDL(text, path=None):
+    tokens = TOKEN.findall(stripComments(text))
+    pos = 0
+    where = path or "<hdl>"
+
+    def take(expected=None):
+        nonlocal pos
+        if pos >= len(tokens):
+            raise ValueError(f"{where}: unexpected end of file")
+        token = tokens[pos]
+        pos += 1
+        if expected is not None and token != expected:
+            raise ValueError(f"{where}: expected '{expected}', found '{token}'")
+        return token
+
+    def peek():
+        return tokens[pos] if pos < len(tokens) else None
+
+    def subscript():
+        if peek() != "[":
+            return None
+        take("[")
+        first = int(take())
+        last = first
+        if peek() == "..":
+            take("..")
+            last = int(take())
+        take("]")
+        return first, last
+
+    def pinList():
+        pins = {}
+        while True:
+            name = take()
+            width = 1
+            if peek() == "[":
+                take("[")
+                width = int(take())
+                take("]")
+            pins[name] = width
+            if take() == ";":
+                return pins
+
+    take("CHIP")
+    name = take()
+    take("{")
+    inputs, outputs, parts = {}, {}, []
+    while peek() != "}":
+        keyword = take()
+        if keyword == "IN":
+            inputs.update(pinList())
+        elif keyword == "OUT":
+            outputs.update(pinList())
+        elif keyword == "PARTS":
+            take(":")
+            while peek() not in ("}", None):
+                part = take()
+                take("(")
+                connections = []
+                while True:
+                    pin = take()
+                    pinrange = subscript()
+                    take("=")
+                    net = take()
+                    netrange = subscript()
+                    connections.append((pin, pinrange, net, netrange))
+                    if take() == ")":
+                        break
+                take(";")
+                parts.append((part, connections))
+        else:
+            raise ValueError(f"{where}: unsupported statement '{keyword}'")
+    take("}")
+    return ChipDefinition(name, inputs, outputs, parts, path)
+
+
+def sliced(nets, subrange, where):
+    if subrange is None:
+        return nets
+    first, last = subrange
+    if not 0 <= first <= last < len(nets):
+        raise ValueError(f"{where}: [{first}..{last}] is outside a {len(nets)}-bit bus")
+    return nets[first : last + 1]
+
+
+class Builtin:
+    """
+    A chip implemented in Python. Outputs depend on the pins listed in
+    COMBINATIONAL within a half-cycle, and otherwise only on state that
+    tock updates.
+    """
+
+    INPUTS = {}
+    OUTPUTS = {}
+    COMBINATIONAL = ()
+
+    def __init__(self, pins):
+        self.pins = pins
+
+    def read(self, values, pin):
+        return sum(values[net] << i for i, net in enumerate(self.pins[pin]))
+
+    def write(self, values, pin, value):
+        """Sets an output, returning the nets that changed."""
+        changed = []
+        for i, net in enumerate(self.pins[pin]):
+            bit = value >> i & 1
+            if values[net] != bit:
+                values[net] = bit
+                changed.append(net)
+        return changed
+
+    def evaluate(self, values):
+        return []
+
+    def tick(self, values):
+        pass
+
+    def tock(self, values):
+        return []
+
+
+class Register(Builtin):
+    INPUTS = {"in": 16, "load": 1}
+    OUTPUTS = {"out": 16}
+
+    def __init__(self, pins):
+        super().__init__(pins)
+        self.state = 0
+        self.next = None
+
+    def evaluate(self, values):
+        return self.write(values, "out", self.state)
+
+    def tick(self, values):
+        self.next = self.read(values, "in") if self.read(values, "load") else None
+
+    def tock(self, values):
+        if self.next is None:
+            return []
+        self.state = self.next
+        return self.write(values, "out", self.state)
+
+
+class ARegister(Register):
+    pass
+
+
+class DRegister(Register):
+    pass
+
+
+class PC(Register):
+    INPUTS = {"in": 16, "reset": 1, "load": 1, "inc": 1}
+
+    def tick(self, values):
+        if self.read(values, "reset"):
+            self.next = 0
+        elif self.read(values, "load"):
+            self.next = self.read(values, "in")
+        elif self.read(values, "inc"):
+            self.next = (self.state + 1) & 0xFFFF
+        else:
+            self.next = None
+
+
+class RAM(Builtin):
+    ADDRESS = 14
+    OUTPUTS = {"out": 16}
+    COMBINATIONAL = ("address",)
+
+    def __init__(self, pins):
+        super().__init__(pins)
+        self.memory = array("H", bytes(2 << self.ADDRESS))
+        self.pending = None
+
+    def evaluate(self, values):
+        return self.write(values, "out", self.memory[self.read(values, "address")])
+
+    def tick(self, values):
+        if self.read(values, "load"):
+            self.pending = (self.read(values, "address"), self.read(values, "in"))
+        else:
+            self.pending = None
+
+    def tock(self, values):
+        if self.pending is None:
+            return []
+        address, value = self.pending
+        self.memory[address] = value
+        return self.evaluate(values)
+
+
+def ramClass(name, bits):
+    inputs = {"in": 16, "load": 1, "address": bits}
+    return type(name, (RAM,), {"ADDRESS": bits, "INPUTS": inputs})
+
+
+class ROM32K(Builtin):
+    INPUTS = {"address": 15}
+    OUTPUTS = {"out": 16}
+    COMBINATIONAL = ("address",)
+
+    def __init__(self, pins):
+        super().__init__(pins)
+        self.memory = array("H", bytes(2 << 15))
+
+    def evaluate(self, values):
+        return self.write(values, "out", self.memory[self.read(values, "address")])
+
+
+class Keyboard(Builtin):
+    OUTPUTS = {"out": 16}
+
+    def __init__(self, pins):
+        super().__init__(pins)
+        self.key = 0
+
+    def evaluate(self, values):
+        return self.write(values, "out", self.key)
+
+
+BUILTIN_CHIPS = {
+    "Register": Register,
+    "ARegister": ARegister,
+    "DRegister": DRegister,
+    "PC": PC,
+    "RAM8": ramClass("RAM8", 3),
+    "RAM64": ramClass("RAM64", 6),
+    "RAM512": ramClass("RAM512", 9),
+    "RAM4K": ramClass("RAM4K", 12),
+    "RAM16K": ramClass("RAM16K", 14),
+    "Screen": ramClass("Screen", 13),
+    "ROM32K": ROM32K,
+    "Keyboard": Keyboard,
+}
+
+PRIMITIVES = {
+    "Nand": ChipDefinition("Nand", {"a": 1, "b": 1}, {"out": 1}, []),
+    "DFF": ChipDefinition("DFF", {"in": 1}, {"out": 1}, []),
+}
+
+
+class Library:
+    """
+    Finds chip definitions: Nand and DFF, then the chips forced to their
+    builtin versions, then .hdl files along the search path, then any
+    other builtin.
+    """
+
+    def __init__(self, path, builtins=None):
+        self.path = path
+        self.builtins = DEFAULT_BUILTINS if builtins is None else set(builtins)
+        self.definitions = {}
+
+    def find(self, name):
+        if name in PRIMITIVES:
+            return PRIMITIVES[name]
+        if name in self.definitions:
+            return self.definitions[name]
+        cls = BUILTIN_CHIPS.get(name)
+        definition = None
+        if cls is None or name not in self.builtins:
+            for directory in self.path:
+                hdlpath = os.path.join(directory, f"{name}.hdl")
+                if os.path.exists(hdlpath):
+                    with open(hdlpath) as f:
+                        definition = parseHDL(f.read(), hdlpath)
+                    if definition.name != name:
+                        raise ValueError(f"{hdlpath} defines {definition.name}, not {name}")
+                    break
+        if definition is None and cls is not None:
+            definition = ChipDefinition(name, cls.INPUTS, cls.OUTPUTS, [])
+            definition.builtin = cls
+        if definition is None:
+            raise ValueError(f"No HDL or builtin for chip {name}")
+        self.definitions[name] = definition
+        return definition
+
+
+def searchPath(hdlpath):
+    """The chip's own directory, then this repository's chapters."""
+    directory = os.path.dirname(os.path.abspath(hdlpath))
+    chapters = sorted(
+        os.path.join(ROOT, entry)
+        for entry in os.listdir(ROOT)
+        if os.path.isdir(os.path.join(ROOT, entry)) and not entry.startswith(".")
+    )
+    return [directory] + [d for d in chapters if d != directory]
+
+
+class Netlist:
+    """Flattens a chip, joining the nets every pin bit is wired to."""
+
+    def __init__(self, library):
+        self.library = library
+        # Union-find over net ids; 0 and 1 are the constants
+        self.parent = [FALSE, TRUE]
+        self.nands = []
+        self.dffs = []
+        self.blocks = []
+
+    def newNets(self, width):
+        first = len(self.parent)
+        self.parent.extend(range(first, first + width))
+        return list(range(first, first + width))
+
+    def find(self, net):
+        parent = self.parent
+        while parent[net] != net:
+            parent[net] = parent[parent[net]]
+            net = parent[net]
+        return net
+
+    def union(self, a, b, where):
+        a = self.find(a)
+        b = self.find(b)
+        if a == b:
+            return
+        if a <= TRUE and b <= TRUE:
+            raise ValueError(f"{where}: true and false are wired together")
+        # A constant stays the root, so the net keeps its value
+        if b <= TRUE:
+            a, b = b, a
+        self.parent[b] = a
+
+    def instantiate(self, definition, pins):
+        """Adds a chip whose pins are already given nets; returns its internal nets."""
+        if definition.name == "Nand":
+            self.nands.append((pins["a"][0], pins["b"][0], pins["out"][0]))
+            return {}
+        if definition.name == "DFF":
+            self.dffs.append((pins["in"][0], pins["out"][0]))
+            return {}
+        builtin = getattr(definition, "builtin", None)
+        if builtin is not None:
+            self.blocks.append(builtin(pins))
+            return {}
+
+        where = definition.path or definition.name
+        chippins = definition.pins()
+        parts = [(self.library.find(part), connections) for part, connections in definition.parts]
+
+        # An internal net is as wide as the output slice driving it
+        widths = {}
+        for part, connections in parts:
+            partpins = part.pins()
+            for pin, pinrange, net, netrange in connections:
+                if pin not in partpins:
+                    raise ValueError(f"{where}: {part.name} has no pin '{pin}'")
+                if net in chippins or net in ("true", "false"):
+                    continue
+                if netrange is not None:
+                    raise ValueError(f"{where}: internal pin '{net}' cannot be subscripted")
+                if pin in part.outputs:
+                    width = partpins[pin] if pinrange is None else pinrange[1] - pinrange[0] + 1
+                    widths[net] = width
+        for part, connections in parts:
+            for pin, pinrange, net, netrange in connections:
+                if net not in chippins and net not in ("true", "false") and net not in widths:
+                    raise ValueError(f"{where}: internal pin '{net}' is never driven")
+        internal = {net: self.newNets(width) for net, width in widths.items()}
+
+        for part, connections in parts:
+            partnets = {pin: self.newNets(width) for pin, width in part.pins().items()}
+            wired = set()
+            for pin, pinrange, net, netrange in connections:
+                bits = sliced(partnets[pin], pinrange, where)
+                if net in ("true", "false"):
+                    targets = [TRUE if net == "true" else FALSE] * len(bits)
+                else:
+                    source = pins[net] if net in chippins else internal[net]
+                    targets = sliced(source, netrange, where)
+                if len(targets) != len(bits):
+                    raise ValueError(
+                        f"{where}: {part.name}.{pin} is {len(bits)} bits wide but '{net}' is {len(targets)}"
+                    )
+                for bit, target in zip(bits, targets):
+                    self.union(bit, target, where)
+                wired.update(bits)
+            # Unconnected inputs read as false
+            for pin in part.inputs:
+                for bit in partnets[pin]:
+                    if bit not in wired:
+                        self.union(bit, FALSE, where)
+            self.instantiate(part, partnets)
+        return internal
+
+
+class Chip:
+    """
+    A flattened chip ready to simulate. In "event" mode set, eval, tick and
+    tock only re-evaluate what a change can reach; "full" mode evaluates
+    every gate each time, for comparison, and "compiled" does the same
+    through straight-line Python generated for the netlist.
+    """
+
+    def __init__(self, definition, library, mode="event"):
+        if mode not in MODES:
+            raise ValueError(f"Unknown mode: {mode}")
+        self.name = definition.name
+        self.mode = mode
+        netlist = Netlist(library)
+        pins = {pin: netlist.newNets(width) for pin, width in definition.pins().items()}
+        internal = netlist.instantiate(definition, pins)
+        self.inputs = list(definition.inputs)
+
+        # Number the surviving nets densely, the constants first
+        find = netlist.find
+        ids = {FALSE: FALSE, TRUE: TRUE}
+        for net in range(len(netlist.parent)):
+            root = find(net)
+            if root not in ids:
+                ids[root] = len(ids)
+
+        def renumber(nets):
+            return [ids[find(net)] for net in nets]
+
+        self.pins = {pin: renumber(nets) for pin, nets in {**pins, **internal}.items()}
+        self.nets = len(ids)
+        self.values = bytearray(self.nets)
+        self.values[TRUE] = 1
+        self.nandA = array("l", renumber(a for a, _, _ in netlist.nands))
+        self.nandB = array("l", renumber(b for _, b, _ in netlist.nands))
+        self.nandOut = array("l", renumber(out for _, _, out in netlist.nands))
+        self.dffIn = array("l", renumber(i for i, _ in netlist.dffs))
+        self.dffOut = array("l", renumber(o for _, o in netlist.dffs))
+        self.latched = bytes(len(self.dffIn))
+        self.blocks = netlist.blocks
+        for block in self.blocks:
+            block.pins = {pin: renumber(nets) for pin, nets in block.pins.items()}
+
+        self.levelize()
+        # Node sequences and compiled functions for eval, by the pins wanted
+        self.cones = {}
+        self.time = 0
+        self.ticked = False
+        # Gate and block evaluations, to compare the modes
+        self.evaluations = 0
+        for block in self.blocks:
+            block.evaluate(self.values)
+        self.evaluateAll()
+
+    def levelize(self):
+        """
+        Orders the nodes, Nand gates then builtin blocks, so each comes
+        after whatever drives its inputs, and builds the fan-out index.
+        """
+        gates = len(self.nandOut)
+        inputs = [(a, b) for a, b in zip(self.nandA, self.nandB)]
+        outputs = [(out,) for out in self.nandOut]
+        for block in self.blocks:
+            inputs.append(
+                tuple(net for pin in block.COMBINATIONAL for net in block.pins[pin])
+            )
+            outputs.append(tuple(net for pin in block.OUTPUTS for net in block.pins[pin]))
+
+        driver = {}
+        for node, nets in enumerate(outputs):
+            for net in nets:
+                if net in driver or net <= TRUE:
+                    raise ValueError(f"{self.name}: net driven twice")
+                driver[net] = node
+        fanout = [[] for _ in range(self.nets)]
+        waiting = [0] * len(inputs)
+        for node, nets in enumerate(inputs):
+            for net in set(nets):
+                fanout[net].append(node)
+                if net in driver:
+                    waiting[node] += 1
+
+        level = [0] * len(inputs)
+        order = [node for node in range(len(inputs)) if not waiting[node]]
+        for node in order:
+            for net in outputs[node]:
+                for reader in fanout[net]:
+                    level[reader] = max(level[reader], level[node] + 1)
+                    waiting[reader] -= 1
+                    if not waiting[reader]:
+                        order.append(reader)
+        if len(order) != len(inputs):
+            raise ValueError(f"{self.name}: combinational loop")
+
+        self.gates = gates
+        self.order = order
+        self.level = level
+        self.fanout = fanout
+        self.buckets = [[] for _ in range(max(level, default=0) + 1)]
+        self.queued = bytearray(len(inputs))
+        self.lowest = len(self.buckets)
+
+    def schedule(self, net):
+        level = self.level
+        queued = self.queued
+        buckets = self.buckets
+        for node in self.fanout[net]:
+            if not queued[node]:
+                queued[node] = 1
+                buckets[level[node]].append(node)
+                if level[node] < self.lowest:
+                    self.lowest = level[node]
+
+    def cone(self, pins):
+        """
+        The nodes eval must run, in order, to settle `pins`, or every node
+        for None, and in compiled mode the function that runs them. Builtins
+        with no combinational inputs are left out: their outputs only change
+        at tock or through update, which write them.
+        """
+        if pins in self.cones:
+            return self.cones[pins]
+        gates = self.gates
+        blocks = self.blocks
+        nodes = [
+            node for node in self.order if node < gates or blocks[node - gates].COMBINATIONAL
+        ]
+        if pins is not None:
+            driver = {out: node for node, out in enumerate(self.nandOut)}
+            for i, block in enumerate(blocks):
+                for pin in block.OUTPUTS:
+                    for net in block.pins[pin]:
+                        driver[net] = gates + i
+            wanted = set()
+            pending = [net for pin in pins for net in self.pins[pin]]
+            while pending:
+                node = driver.get(pending.pop())
+                if node is None or node in wanted:
+                    continue
+                wanted.add(node)
+                if node < gates:
+                    pending += (self.nandA[node], self.nandB[node])
+                else:
+                    block = blocks[node - gates]
+                    pending += [net for pin in block.COMBINATIONAL for net in block.pins[pin]]
+            nodes = [node for node in nodes if node in wanted]
+        if self.mode == "compiled":
+            cone = (len(nodes), self.compile(nodes))
+        else:
+            cone = (len(nodes), nodes)
+        self.cones[pins] = cone
+        return cone
+
+    def compile(self, nodes):
+        """
+        Generates a function evaluating `nodes` with every net in a local
+        variable. Only nets something outside the function may read, pins,
+        DFF inputs and builtin inputs, are stored back into the values.
+        """
+        gates = self.gates
+        blocks = self.blocks
+        stored = {net for nets in self.pins.values() for net in nets}
+        stored.update(self.dffIn)
+        for block in blocks:
+            stored.update(net for pin in block.INPUTS for net in block.pins[pin])
+        local = set()
+        lines = []
+
+        def read(net):
+            if net not in local:
+                local.add(net)
+                lines.append(f"    n{net} = v[{net}]")
+            return f"n{net}"
+
+        for node in nodes:
+            if node < gates:
+                a, b = read(self.nandA[node]), read(self.nandB[node])
+                out = self.nandOut[node]
+                local.add(out)
+                target = f"n{out} = v[{out}]" if out in stored else f"n{out}"
+                lines.append(f"    {target} = 1 - ({a} & {b})")
+            else:
+                block = blocks[node - gates]
+                lines.append(f"    blocks[{node - gates}].evaluate(v)")
+                for pin in block.OUTPUTS:
+                    for net in block.pins[pin]:
+                        local.discard(net)
+        source = "def evaluate(v, blocks):\n" + "\n".join(lines or ["    pass"]) + "\n"
+        namespace = {}
+        exec(compile(source, f"<{self.name}>", "exec"), namespace)
+        return namespace["evaluate"]
+
+    def evaluateAll(self, pins=None):
+        count, nodes = self.cone(pins)
+        self.evaluations += count
+        if self.mode == "compiled":
+            nodes(self.values, self.blocks)
+            return
+        values = self.values
+        nandA, nandB, nandOut = self.nandA, self.nandB, self.nandOut
+        gates = self.gates
+        blocks = self.blocks
+        for node in nodes:
+            if node < gates:
+                values[nandOut[node]] = 0 if values[nandA[node]] & values[nandB[node]] else 1
+            else:
+                blocks[node - gates].evaluate(values)
+
+    def propagate(self):
+        """Evaluates the scheduled nodes level by level, scheduling their readers."""
+        values = self.values
+        nandA, nandB, nandOut = self.nandA, self.nandB, self.nandOut
+        gates = self.gates
+        blocks = self.blocks
+        buckets = self.buckets
+        queued = self.queued
+        level = self.level
+        fanout = self.fanout
+        evaluations = 0
+        for depth in range(self.lowest, len(buckets)):
+            bucket = buckets[depth]
+            if not bucket:
+                continue
+            evaluations += len(bucket)
+            for node in bucket:
+                queued[node] = 0
+                if node < gates:
+                    out = nandOut[node]
+                    value = 0 if values[nandA[node]] & values[nandB[node]] else 1
+                    if values[out] == value:
+                        continue
+                    values[out] = value
+                    changed = (out,)
+                else:
+                    changed = blocks[node - gates].evaluate(values)
+                # Readers are always on a deeper level, still to come
+                for net in changed:
+                    for reader in fanout[net]:
+                        if not queued[reader]:
+                            queued[reader] = 1
+                            buckets[level[reader]].append(reader)
+            bucket.clear()
+        self.lowest = len(buckets)
+        self.evaluations += evaluations
+
+    def eval(self, pins=None):
+        """
+        Settles the chip. Given a tuple of pins, the full modes settle only
+        what drives those; the rest stays stale until the next whole eval.
+        """
+        if self.mode == "event":
+            self.propagate()
+        else:
+            self.evaluateAll(pins)
+
+    def changed(self, nets):
+        if self.mode == "event":
+            for net in nets:
+                self.schedule(net)
+
+    def set(self, pin, value):
+        if pin not in self.inputs:
+            raise ValueError(f"{self.name} has no input pin '{pin}'")
+        values = self.values
+        changed = []
+        for i, net in enumerate(self.pins[pin]):
+            bit = value >> i & 1
+            if values[net] != bit:
+                values[net] = bit
+                changed.append(net)
+        self.changed(changed)
+
+    def get(self, pin):
+        values = self.values
+        return sum(values[net] << i for i, net in enumerate(self.pins[pin]))
+
+    def tick(self):
+        """Settles the inputs, then latches every DFF and builtin."""
+        self.eval()
+        values = self.values
+        self.latched = bytes([values[net] for net in self.dffIn])
+        for block in self.blocks:
+            block.tick(values)
+        self.ticked = True
+
+    def tock(self, settle=True):
+        """
+        Drives the latched values out and settles the chip again, unless
+        the caller will eval before reading anything.
+        """
+        values = self.values
+        changed = []
+        for out, value in zip(self.dffOut, self.latched):
+            if values[out] != value:
+                values[out] = value
+                changed.append(out)
+        for block in self.blocks:
+            changed.extend(block.tock(values))
+        self.changed(changed)
+        if settle:
+            self.eval()
+        self.ticked = False
+        self.time += 1
+
+    def snapshot(self):
+        """The nets, DFFs, builtins and clock, taken while nothing is scheduled."""
+        blocks = [
+            copy.deepcopy({k: v for k, v in vars(block).items() if k != "pins"})
+            for block in self.blocks
+        ]
+        return bytes(self.values), self.latched, blocks, self.time, self.ticked
+
+    def restore(self, snapshot):
+        values, self.latched, blocks, self.time, self.ticked = snapshot
+        self.values[:] = values
+        for block, state in zip(self.blocks, blocks):
+            vars(block).update(copy.deepcopy(state))
+        for bucket in self.buckets:
+            bucket.clear()
+        self.queued = bytearray(len(self.queued))
+        self.lowest = len(self.buckets)
+
+    def timeLabel(self):
+        return f"{self.time}+" if self.ticked else str(self.time)
+
+    def update(self, block):
+        """Re-reads a builtin whose state changed from outside, eg a key press."""
+        self.changed(block.evaluate(self.values))
+
+    def block(self, name):
+        """The first builtin block of a kind, eg to load a ROM32K."""
+        for block in self.blocks:
+            if type(block).__name__ == name:
+                return block
+        raise ValueError(f"{self.name} has no {name}")
+
+
+def loadChip(hdlpath, builtins=None, mode="event"):
+    library = Library(searchPath(hdlpath), builtins)
+    with open(hdlpath) as f:
+        definition = parseHDL(f.read(), hdlpath)
+    return Chip(definition, library, mode)
+
+
+def parseValue(text):
+    match = VALUE.match(text)
+    if match is None:
+        return int(text) & 0xFFFF
+    fmt, digits = match.groups()
+    base = {"B": 2, "X": 16, "D": 10}[fmt]
+    return int(digits, base) & 0xFFFF
+
+
+class HDLTest:
+    """Runs a chip test script: load, set, eval, tick, tock and output."""
+
+    def __init__(self, path, builtins=None, mode="event"):
+        self.path = path
+        self.dir = os.path.dirname(path)
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        with open(path) as f:
+            self.commands = parseScript(f.read())
+        self.builtins = builtins
+        self.mode = mode
+        self.chip = None
+        self.outputs = []
+        self.columns = []
+        self.comparepath = None
+
+    def value(self, name):
+        if name == "time":
+            return self.chip.timeLabel()
+        if name not in self.chip.pins:
+            raise ValueError(f"Unknown output variable: {name}")
+        return self.chip.get(name)
+
+    def output(self):
+        cells = []
+        for name, fmt, left, width, right in self.columns:
+            value = self.value(name)
+            if isinstance(value, str):
+                text = value.ljust(width)
+            else:
+                text = formatValue(value, fmt, width)
+            cells.append(" " * left + text + " " * right)
+        return "|" + "|".join(cells) + "|"
+
+    def execute(self, commands):
+        for command in commands:
+            op = command[0]
+            if op == "load":
+                self.chip = loadChip(
+                    os.path.join(self.dir, command[1]), self.builtins, self.mode
+                )
+            elif op == "compare-to":
+                self.comparepath = os.path.join(self.dir, command[1])
+            elif op == "output-list":
+                self.columns = [parseOutputSpec(spec) for spec in command[1:]]
+                self.outputs.append(formatHeader(self.columns))
+            elif op == "output":
+                self.outputs.append(self.output())
+            elif op == "set":
+                self.chip.set(command[1], parseValue(command[2]))
+            elif op == "eval":
+                self.chip.eval()
+            elif op == "tick":
+                self.chip.tick()
+            elif op == "tock":
+                self.chip.tock()
+            elif op == "repeat":
+                for _ in range(command[1]):
+                    self.execute(command[2])
+            elif op in ("output-file", "echo", "clear-echo"):
+                pass
+            else:
+                raise ValueError(f"Unsupported script command: {op}")
+
+    def run(self):
+        self.execute(self.commands)
+        if self.comparepath is None:
+            return True
+        return matchesCompareFile(self.outputs, self.comparepath)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run chip test scripts")
+    parser.add_argument("scripts", nargs="+", help=".tst files for HDL chips")
+    parser.add_argument("--mode", choices=MODES, default="event")
+    parser.add_argument(
+        "--builtin",
+        action="append",
+        metavar="CHIP",
+        help="use the Python version of a chip even where its .hdl exists",
+    )
+    parser.add_argument(
+        "--stats", action="store_true", help="print the netlist size and evaluations"
+    )
+    args = parser.parse_args()
+    builtins = DEFAULT_BUILTINS | set(args.builtin or ())
+
+    failures = 0
+    for path in args.scripts:
+        test = HDLTest(path, builtins, args.mode)
+        try:
+            passed = test.run()
+        except ValueError as e:
+            failures += 1
+            print(f"ERROR {path}: {e}")
+            continue
+        failures += not passed
+        print(f"{'PASS' if passed else 'FAIL'} {path}")
+        if not passed:
+            print("\n".join(test.outputs))
+        chip = test.chip
+        if args.stats and chip is not None:
+            print(
+                f"  {chip.gates} gates, {len(chip.dffIn)} DFFs, {len(chip.blocks)} "
+                f"builtins, {len(chip.buckets)} levels; {chip.evaluations} "
+                f"evaluations over {chip.time} cycles"
+            )
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
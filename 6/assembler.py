@@ -1,6 +1,44 @@
+import argparse
+from array import array
+import difflib
 from enum import Enum, auto
+from multiprocessing import Pool
+import re
 import sys
 
+MAX_ADDRESS = 32767
+ROM_SIZE = 32768
+SYMBOL = re.compile(r"^[A-Za-z_.$:][A-Za-z0-9_.$:]*$")
+# Fewer commands than this per worker are encoded serially: starting the
+# pool would cost more than it saves
+PARALLEL_CHUNK = 16384
+
+
+def closest(token, choices):
+    matches = difflib.get_close_matches(token, [c for c in choices if c], n=1)
+    return matches[0] if matches else None
+
+
+class Diagnostic:
+    def __init__(self, filepath, line, token, message, suggestion=None):
+        self.filepath = filepath
+        self.line = line
+        self.token = token
+        self.message = message
+        self.suggestion = suggestion
+
+    def __str__(self):
+        text = f"{self.filepath or '<source>'}:{self.line}: {self.message} '{self.token}'"
+        if self.suggestion is not None:
+            text += f" (did you mean '{self.suggestion}'?)"
+        return text
+
+
+class AssemblerError(ValueError):
+    def __init__(self, diagnostics):
+        self.diagnostics = diagnostics
+        super().__init__("\n".join(str(d) for d in diagnostics))
+
 
 class Parser:
     class CommandType(Enum):
@@ -9,24 +47,25 @@ class Parser:
         L_COMMAND = auto()
         INVALID_COMMAND = auto()
 
-    def __init__(self, filepath):
+    def __init__(self, filepath, source=None):
         self.filepath = filepath
-        self.file = open(filepath, "r")
+        if source is None:
+            with open(filepath, "r") as file:
+                self.lines = file.readlines()
+        elif isinstance(source, str):
+            self.lines = source.splitlines()
+        else:
+            self.lines = source
+        self.pos = 0
         self.command = None
         self.ctype = None
 
     def hasMoreCommands(self):
-        pos = self.file.tell()
-        line = self.file.readline()
-
-        if not line:
-            return False
-        else:
-            self.file.seek(pos)
-            return True
+        return self.pos < len(self.lines)
 
     def advance(self):
-        line = self.strip(self.file.readline())
+        line = self.strip(self.lines[self.pos])
+        self.pos += 1
         self.command = line
 
     def commandType(self):
@@ -143,110 +182,280 @@ class Code:
     def comp(self, comp_m):
         return self.comp_table[comp_m]
 
+    def validDest(self, dest_m):
+        return len(set(dest_m)) == len(dest_m) and set(dest_m) <= {"A", "D", "M"}
+
+    def suggestComp(self, comp_m):
+        # Commuted operands, eg M+D for D+M, are the most common slip
+        for op in "+&|":
+            x, sep, y = comp_m.partition(op)
+            if sep and y + op + x in self.comp_table:
+                return y + op + x
+        return closest(comp_m, self.comp_table)
+
     def jump(self, jump_m):
         return self.jump_table[jump_m]
 
 
 class SymbolTable:
+    PREDEFINED = {
+        "R0": 0,
+        "R1": 1,
+        "R2": 2,
+        "R3": 3,
+        "R4": 4,
+        "R5": 5,
+        "R6": 6,
+        "R7": 7,
+        "R8": 8,
+        "R9": 9,
+        "R10": 10,
+        "R11": 11,
+        "R12": 12,
+        "R13": 13,
+        "R14": 14,
+        "R15": 15,
+        "SP": 0,
+        "LCL": 1,
+        "ARG": 2,
+        "THIS": 3,
+        "THAT": 4,
+        "SCREEN": 16384,
+        "KBD": 24576,
+    }
+
+    UNDEFINED = -1
+
     def __init__(self):
-        self.table = {
-            "R0": "0",
-            "R1": "1",
-            "R2": "2",
-            "R3": "3",
-            "R4": "4",
-            "R5": "5",
-            "R6": "6",
-            "R7": "7",
-            "R8": "8",
-            "R9": "9",
-            "R10": "10",
-            "R11": "11",
-            "R12": "12",
-            "R13": "13",
-            "R14": "14",
-            "R15": "15",
-            "SP": "0",
-            "LCL": "1",
-            "ARG": "2",
-            "THIS": "3",
-            "THAT": "4",
-            "SCREEN": "16384",
-            "KBD": "24576",
-        }
+        # Symbols are interned to small integer ids; addresses are indexed by id
+        self.ids = {}
+        self.names = []
+        self.addresses = array("i")
+        for symbol, address in self.PREDEFINED.items():
+            self.addEntry(symbol, address)
+
+    def intern(self, symbol):
+        id = self.ids.get(symbol)
+        if id is None:
+            id = len(self.names)
+            self.ids[symbol] = id
+            self.names.append(symbol)
+            self.addresses.append(self.UNDEFINED)
+        return id
 
     def addEntry(self, symbol, address):
-        self.table[symbol] = address
+        self.addresses[self.intern(symbol)] = address
 
     def contains(self, symbol):
-        return symbol in self.table
+        id = self.ids.get(symbol)
+        return id is not None and self.addresses[id] != self.UNDEFINED
 
     def getAddress(self, symbol):
-        return self.table[symbol]
+        return self.addresses[self.ids[symbol]]
+
+    def items(self):
+        for symbol, address in zip(self.names, self.addresses):
+            if address != self.UNDEFINED:
+                yield symbol, address
 
 
 class Assembler:
-    def __init__(self, filepath, writepath):
-        self.parser = Parser(filepath)
+    def __init__(self, filepath, writepath=None, source=None):
+        self.parser = Parser(filepath, source)
         self.code = Code()
         self.symboltable = SymbolTable()
         self.writepath = writepath
         self.filepath = filepath
-
-    def assemble(self):
-        # First pass - build symbol table
+        self.diagnostics = []
+        self.labellines = {}
+
+    def error(self, token, message, suggestion=None):
+        self.diagnostics.append(
+            Diagnostic(self.filepath, self.parser.pos, token, message, suggestion)
+        )
+
+    def checkA(self, symbol):
+        if symbol.isdigit():
+            if int(symbol) > MAX_ADDRESS:
+                self.error(symbol, f"constant larger than {MAX_ADDRESS}")
+        elif not SYMBOL.match(symbol):
+            self.error(symbol, "invalid symbol")
+
+    def checkC(self, dest, comp, jump):
+        code = self.code
+        if comp == "":
+            self.error(self.parser.command, "missing computation")
+        elif comp not in code.comp_table:
+            self.error(comp, "unknown computation", code.suggestComp(comp))
+        if not code.validDest(dest):
+            self.error(dest, "invalid destination")
+        if jump not in code.jump_table:
+            self.error(jump, "unknown jump", closest(jump, code.jump_table))
+
+    def checkL(self, symbol):
+        if not SYMBOL.match(symbol):
+            self.error(symbol, "invalid label")
+        elif symbol in self.labellines:
+            self.error(
+                symbol, f"label already defined on line {self.labellines[symbol]}"
+            )
+        else:
+            self.labellines[symbol] = self.parser.pos
+
+    def parse(self):
+        """
+        First pass - build the symbol table, interning every symbol
+        reference, and validate every command. Problems are collected into
+        self.diagnostics rather than stopping at the first one.
+        """
+        A_COMMAND = Parser.CommandType.A_COMMAND
+        C_COMMAND = Parser.CommandType.C_COMMAND
+        L_COMMAND = Parser.CommandType.L_COMMAND
+
+        commands = []
         romcounter = 0
         while self.parser.hasMoreCommands():
             self.parser.advance()
             type = self.parser.commandType()
 
-            if type == self.parser.CommandType.L_COMMAND:
-                self.symboltable.addEntry(self.parser.symbol(), romcounter)
-            elif type in (
-                self.parser.CommandType.A_COMMAND,
-                self.parser.CommandType.C_COMMAND,
-            ):
+            if type is L_COMMAND:
+                symbol = self.parser.symbol()
+                self.checkL(symbol)
+                self.symboltable.addEntry(symbol, romcounter)
+            elif type is A_COMMAND:
+                symbol = self.parser.symbol()
+                self.checkA(symbol)
+                if symbol.isdigit():
+                    commands.append((type, int(symbol), None))
+                else:
+                    commands.append((type, 0, self.symboltable.intern(symbol)))
+            elif type is C_COMMAND:
+                dest = self.parser.dest()
+                comp = self.parser.comp()
+                jump = self.parser.jump()
+                self.checkC(dest, comp, jump)
+                commands.append((type, dest, comp, jump))
+
+            if type is A_COMMAND or type is C_COMMAND:
                 romcounter += 1
+                if romcounter == ROM_SIZE + 1:
+                    self.error(
+                        self.parser.command, f"program exceeds {ROM_SIZE} ROM words"
+                    )
+
+        return commands
+
+    def check(self):
+        self.parse()
+        return self.diagnostics
+
+    def resolve(self, commands):
+        """
+        Replaces each A-command by its address, allocating variables from 16
+        in order of first use, and each C-command by (dest, comp, jump).
+        This freezes the symbol table, so what remains of pass two can run
+        on any slice of the program independently.
+        """
+        A_COMMAND = Parser.CommandType.A_COMMAND
+        addresses = self.symboltable.addresses
+        resolved = []
+        nextram = 16
+        for command in commands:
+            if command[0] is A_COMMAND:
+                _, address, id = command
+                if id is not None:
+                    address = addresses[id]
+                    if address == SymbolTable.UNDEFINED:
+                        address = addresses[id] = nextram
+                        nextram += 1
+                resolved.append(address)
+            else:
+                resolved.append(command[1:])
+        return resolved
+
+    def text(self, jobs=1):
+        """The machine code as one string, encoded by up to `jobs` processes."""
+        commands = self.parse()
+        if self.diagnostics:
+            raise AssemblerError(self.diagnostics)
 
         # Second pass - generate machine code
-        self.parser = Parser(self.filepath)
+        commands = self.resolve(commands)
+        size = max(PARALLEL_CHUNK, -(-len(commands) // max(jobs, 1)))
+        if len(commands) <= size:
+            return encode(commands)
+        chunks = [commands[i : i + size] for i in range(0, len(commands), size)]
+        with Pool(len(chunks)) as pool:
+            return "".join(pool.map(encode, chunks))
+
+    def translate(self, jobs=1):
+        return self.text(jobs).splitlines()
+
+    def encodeC(self, dest, comp, jump):
+        return encodeC(self.code, dest, comp, jump)
+
+    def assemble(self, jobs=1):
+        text = self.text(jobs)
         with open(self.writepath, "w") as file:
-            nextram = 16
-            while self.parser.hasMoreCommands():
-                self.parser.advance()
-                type = self.parser.commandType()
-                line = None
-
-                if type == self.parser.CommandType.A_COMMAND:
-                    symbol = self.parser.symbol()
-                    if not symbol.isdigit():
-                        if not self.symboltable.contains(symbol):
-                            self.symboltable.addEntry(symbol, nextram)
-                            nextram += 1
-                        symbol = self.symboltable.getAddress(symbol)
-                    line = bin(int(symbol))[2:].zfill(16)
-
-                elif type == self.parser.CommandType.C_COMMAND:
-                    dest = self.parser.dest()
-                    comp = self.parser.comp()
-                    jump = self.parser.jump()
-                    line = (
-                        "111"
-                        + self.code.comp(comp)
-                        + self.code.dest(dest)
-                        + self.code.jump(jump)
-                    )
+            file.write(text)
 
-                if line:
-                    file.write(line + "\n")
 
+def encodeC(code, dest, comp, jump):
+    return "111" + code.comp(comp) + code.dest(dest) + code.jump(jump)
+
+
+def encode(commands):
+    """
+    Encodes resolved commands, see Assembler.resolve, into lines of machine
+    code, each ending in a newline, packed into one string for a worker to
+    hand back. Few distinct C-commands occur, so each is encoded once.
+    """
+    code = Code()
+    cache = {}
+    lines = []
+    for command in commands:
+        if command.__class__ is int:
+            lines.append(format(command, "016b"))
+        else:
+            line = cache.get(command)
+            if line is None:
+                line = cache[command] = encodeC(code, *command)
+            lines.append(line)
+    lines.append("")
+    return "\n".join(lines)
 
-def main():
-    filepath = sys.argv[1]
-    writepath = sys.argv[2]
 
-    assembler = Assembler(filepath, writepath)
-    assembler.assemble()
+def main():
+    parser = argparse.ArgumentParser(description="Hack assembler")
+    parser.add_argument("filepath")
+    parser.add_argument("writepath", nargs="?")
+    parser.add_argument(
+        "--check", action="store_true", help="validate only, write no output"
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="processes to encode pass two with, for programs large enough to gain",
+    )
+    args = parser.parse_args()
+    if not args.check and args.writepath is None:
+        parser.error("an output path is required unless --check is given")
+
+    assembler = Assembler(args.filepath, args.writepath)
+    if args.check:
+        diagnostics = assembler.check()
+    else:
+        try:
+            assembler.assemble(args.jobs)
+            diagnostics = []
+        except AssemblerError as e:
+            diagnostics = e.diagnostics
+
+    for diagnostic in diagnostics:
+        print(diagnostic, file=sys.stderr)
+    sys.exit(1 if diagnostics else 0)
 
 
 if __name__ == "__main__":
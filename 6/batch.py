@@ -0,0 +1,110 @@
+import argparse
+from array import array
+from multiprocessing import Pool, shared_memory
+import os
+import sys
+import time
+
+from emulator import Emulator
+from tst import TestScript, findScripts
+
+# Shared memory block holding every ROM image, attached once per worker
+ROMS = None
+
+
+def attach(name):
+    global ROMS
+    ROMS = shared_memory.SharedMemory(name=name)
+
+
+def romWords(offset, size):
+    words = array("H")
+    words.frombytes(ROMS.buf[offset : offset + 2 * size])
+    return words
+
+
+def runScript(job):
+    path, offset, size, symbols = job
+    start = time.perf_counter()
+    emulator = Emulator(romWords(offset, size), symbols)
+    script = TestScript(path, emulator)
+    passed = script.run()
+    elapsed = time.perf_counter() - start
+    return (path, passed, script.emulator.cycles, elapsed, script.outputs)
+
+
+class RomPack:
+    """Packs ROM images end to end, storing each distinct image once."""
+
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = {}
+
+    def add(self, emulator):
+        if emulator.digest not in self.offsets:
+            self.offsets[emulator.digest] = len(self.data)
+            self.data.extend(emulator.rom.tobytes())
+        return self.offsets[emulator.digest], len(emulator.rom)
+
+    def share(self):
+        shm = shared_memory.SharedMemory(create=True, size=max(len(self.data), 1))
+        shm.buf[: len(self.data)] = self.data
+        return shm
+
+
+def scriptJobs(paths, pack):
+    jobs = []
+    for path in findScripts(paths):
+        emulator = Emulator()
+        emulator.load(TestScript(path).programPath())
+        offset, size = pack.add(emulator)
+        jobs.append((path, offset, size, emulator.symbols))
+    return jobs
+
+
+def runBatch(jobs, pack, worker=runScript, processes=None):
+    """
+    Runs jobs across a process pool, yielding each result as soon as it
+    finishes. Jobs refer to their ROM by offset into the shared pack.
+    """
+    shm = pack.share()
+    try:
+        with Pool(processes, initializer=attach, initargs=(shm.name,)) as pool:
+            yield from pool.imap_unordered(worker, jobs)
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run emulator tests in parallel")
+    parser.add_argument("paths", nargs="+", help="test scripts or directories")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count())
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    pack = RomPack()
+    jobs = scriptJobs(args.paths, pack)
+
+    start = time.perf_counter()
+    failures = 0
+    cycles = 0
+    for path, passed, n, elapsed, outputs in runBatch(jobs, pack, processes=args.jobs):
+        failures += not passed
+        cycles += n
+        status = "PASS" if passed else "FAIL"
+        rate = n / elapsed if elapsed else 0
+        print(f"{status} {path} ({n} cycles, {rate:,.0f} cycles/s)", flush=True)
+        if not passed and args.verbose:
+            print("\n".join(outputs))
+    wall = time.perf_counter() - start
+
+    print(
+        f"{len(jobs) - failures} passed, {failures} failed in {wall:.2f}s, "
+        f"{cycles} cycles, {cycles / wall:,.0f} cycles/s"
+    )
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
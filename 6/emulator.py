@@ -0,0 +1,505 @@
+import argparse
+from array import array
+import hashlib
+import json
+import struct
+
+from assembler import Assembler
+from instrument import Counters
+from native import selectBuiltins
+from tracer import Recorder, putVarint
+
+RAM_SIZE = 32768
+ROM_SIZE = 32768
+SCREEN = 16384
+KBD = 24576
+
+# 0;JMP
+JMP = 0b1110101010000111
+
+# A, D, PC and the cycle counter, followed by the raw RAM words
+STATE = struct.Struct("<HHHQ")
+
+COMP = {
+    0b101010: lambda x, y: 0,
+    0b111111: lambda x, y: 1,
+    0b111010: lambda x, y: 0xFFFF,
+    0b001100: lambda x, y: x,
+    0b110000: lambda x, y: y,
+    0b001101: lambda x, y: x ^ 0xFFFF,
+    0b110001: lambda x, y: y ^ 0xFFFF,
+    0b001111: lambda x, y: -x & 0xFFFF,
+    0b110011: lambda x, y: -y & 0xFFFF,
+    0b011111: lambda x, y: (x + 1) & 0xFFFF,
+    0b110111: lambda x, y: (y + 1) & 0xFFFF,
+    0b001110: lambda x, y: (x - 1) & 0xFFFF,
+    0b110010: lambda x, y: (y - 1) & 0xFFFF,
+    0b000010: lambda x, y: (x + y) & 0xFFFF,
+    0b010011: lambda x, y: (x - y) & 0xFFFF,
+    0b000111: lambda x, y: (y - x) & 0xFFFF,
+    0b000000: lambda x, y: x & y,
+    0b010101: lambda x, y: x | y,
+}
+
+
+def alu(c):
+    """Returns the ALU function for the six control bits zx nx zy ny f no."""
+    if c in COMP:
+        return COMP[c]
+
+    def op(x, y):
+        if c & 0b100000:
+            x = 0
+        if c & 0b010000:
+            x ^= 0xFFFF
+        if c & 0b001000:
+            y = 0
+        if c & 0b000100:
+            y ^= 0xFFFF
+        out = (x + y) & 0xFFFF if c & 0b000010 else x & y
+        if c & 0b000001:
+            out ^= 0xFFFF
+        return out
+
+    return op
+
+
+def decode(word):
+    if not word & 0x8000:
+        return word
+    comp = alu((word >> 6) & 0b111111)
+    return (comp, (word >> 12) & 1, (word >> 3) & 0b111, word & 0b111)
+
+
+def signed(value):
+    return value - 0x10000 if value & 0x8000 else value
+
+
+def isIdleBody(body):
+    """
+    True when running `body` again from its first word cannot differ from
+    the previous run: no jumps before the last word, no RAM writes, and
+    every register it reads is either set earlier in the body or never set.
+    """
+    written = set()
+    readfirst = set()
+    for k, word in enumerate(body):
+        if not word & 0x8000:
+            written.add("A")
+            continue
+        c = (word >> 6) & 0b111111
+        dest = (word >> 3) & 0b111
+        jump = word & 0b111
+        if dest & 1 or (jump and k != len(body) - 1):
+            return False
+        reads = set()
+        if not c & 0b100000:
+            reads.add("D")
+        # Reading M reads A for the address, as does jumping
+        if not c & 0b001000 or jump:
+            reads.add("A")
+        readfirst |= reads - written
+        if dest & 4:
+            written.add("A")
+        if dest & 2:
+            written.add("D")
+    return not readfirst & written
+
+
+def idleLoops(rom):
+    """
+    Finds loops that spin without side effects, eg the halt loop
+    `(L) @L 0;JMP` or polling `(L) @KBD D=M @L D;JEQ`: straight-line code
+    from a head h to a jump whose target is loaded just before it. Once
+    such a loop goes round once, it goes round identically until something
+    outside the CPU changes RAM. Returns {head: instructions per iteration}.
+    """
+    loops = {}
+    for j in range(1, len(rom)):
+        word = rom[j]
+        if not word & 0x8000 or not word & 0b111 or rom[j - 1] & 0x8000:
+            continue
+        head = rom[j - 1]
+        if head <= j and head not in loops and isIdleBody(rom[head : j + 1]):
+            loops[head] = j - head + 1
+    return loops
+
+
+class Emulator:
+    def __init__(self, rom=None, symbols=None):
+        self.rom = array("H")
+        self.code = []
+        self.idle = {}
+        # OS functions run natively, by name and by entry address
+        self.builtins = {}
+        self.natives = {}
+        self.nativeState = {}
+        # Access counters, or None to run the uninstrumented loop
+        self.counters = None
+        # Trace recorder, or None
+        self.trace = None
+        self.symbols = symbols or {}
+        self.digest = None
+        self.ram = array("H", bytes(2 * RAM_SIZE))
+        self.reset()
+        if rom is not None:
+            self.setRom(rom)
+
+    def load(self, path):
+        if path.endswith(".asm"):
+            assembler = Assembler(path)
+            words = [int(line, 2) for line in assembler.translate()]
+            symbols = dict(assembler.symboltable.items())
+        else:
+            with open(path) as f:
+                words = [int(line.strip(), 2) for line in f if line.strip()]
+            symbols = {}
+        self.symbols = symbols
+        self.setRom(words)
+
+    def setRom(self, words):
+        if len(words) > ROM_SIZE:
+            raise ValueError(f"Program too large for ROM: {len(words)} words")
+        self.rom = array("H", words)
+        self.digest = hashlib.sha1(self.rom.tobytes()).hexdigest()
+        self.idle = idleLoops(self.rom)
+        self.natives = self.nativeAddresses()
+        # Past the end of the program the ROM reads as zero, ie @0
+        self.code = [decode(word) for word in self.rom]
+        self.code.extend([0] * (ROM_SIZE - len(self.code)))
+
+    def enableCounters(self):
+        """
+        Starts counting RAM reads and writes, instructions and the stack
+        pointer's high-water mark; see instrument.py. Cycles fast-forwarded
+        through idle loops are not counted.
+        """
+        self.counters = Counters()
+        return self.counters
+
+    def startTrace(self, interval=65536):
+        """
+        Records every following cycle; see tracer.py. Idle loops are not
+        fast-forwarded and OS functions do not run natively meanwhile, as
+        neither would leave a record of its cycles.
+        """
+        self.trace = Recorder(self, interval)
+        return self.trace
+
+    def enableBuiltins(self, names=None):
+        """
+        Runs the named OS functions (all of native.BUILTINS by default) in
+        Python whenever the PC reaches their entry label. Each native call
+        counts as one cycle.
+        """
+        self.builtins = selectBuiltins(names)
+        self.natives = self.nativeAddresses()
+
+    def nativeAddresses(self):
+        return {
+            self.symbols[name]: builtin
+            for name, builtin in self.builtins.items()
+            if name in self.symbols
+        }
+
+    def callNative(self, builtin):
+        """
+        Runs a builtin on the arguments of the frame getCall just built, then
+        returns like getReturn. Returns False when the builtin declines.
+        """
+        nargs, function = builtin
+        ram = self.ram
+        arg = ram[2]
+        args = [ram[(arg + i) & 0x7FFF] for i in range(nargs)]
+        result = function(ram, args, self.nativeState)
+        if result is None:
+            return False
+
+        frame = ram[1]
+        retaddr = ram[(frame - 5) & 0x7FFF]
+        ram[arg & 0x7FFF] = result
+        ram[0] = (arg + 1) & 0xFFFF
+        ram[4] = ram[(frame - 1) & 0x7FFF]
+        ram[3] = ram[(frame - 2) & 0x7FFF]
+        ram[2] = ram[(frame - 3) & 0x7FFF]
+        ram[1] = ram[(frame - 4) & 0x7FFF]
+        # Leave the scratch registers as getReturn would
+        ram[15] = frame
+        if "RET" in self.symbols:
+            ram[self.symbols["RET"]] = retaddr
+        self.A = retaddr
+        self.D = ram[1]
+        self.PC = retaddr & 0x7FFF
+        self.cycles += 1
+        return True
+
+    def reset(self):
+        self.A = 0
+        self.D = 0
+        self.PC = 0
+        self.cycles = 0
+        # Cycles counted without being executed, by fast-forwarding idle loops
+        self.skipped = 0
+
+    def clearRam(self):
+        self.ram = array("H", bytes(2 * RAM_SIZE))
+
+    def snapshot(self):
+        return STATE.pack(self.A, self.D, self.PC, self.cycles) + self.ram.tobytes()
+
+    def restore(self, blob):
+        self.A, self.D, self.PC, self.cycles = STATE.unpack_from(blob)
+        memoryview(self.ram).cast("B")[:] = memoryview(blob)[STATE.size :]
+
+    def peek(self, address):
+        return signed(self.ram[address])
+
+    def poke(self, address, value):
+        self.ram[address] = value & 0xFFFF
+
+    def haltAddresses(self):
+        """
+        Finds the halt loops vm.py emits: `(L) @L 0;JMP` and `@L (L) 0;JMP`.
+        Returns the addresses at which the PC would spin forever.
+        """
+        halts = set()
+        code = self.code
+        for pc, word in enumerate(self.rom):
+            if word == JMP:
+                if code[pc - 1] == pc:
+                    halts.add(pc)
+                elif code[pc - 1] == pc - 1:
+                    halts.add(pc - 1)
+        return halts
+
+    def step(self):
+        self.run(1)
+
+    def run(self, cycles, until=None):
+        """
+        Executes up to `cycles` instructions, stopping early when the PC
+        reaches `until`, an address or a set of addresses. Returns the
+        number of instructions executed. Once an idle loop has gone round
+        once, the rest of its whole iterations are counted without being
+        executed, so the cycle counter and the final state stay exact.
+        """
+        stops = {until} if isinstance(until, int) else set(until or ())
+        if self.trace is not None:
+            return self.trace.run(cycles, stops)
+        execute = self.execute if self.counters is None else self.executeCounted
+        idle = self.idle
+        natives = self.natives
+        watch = stops | idle.keys() | natives.keys() if idle or natives else stops
+        n = execute(cycles, watch)
+        arrival = None
+        while n < cycles and self.PC not in stops:
+            head = self.PC
+            if head in natives and self.callNative(natives[head]):
+                n += 1
+                n += execute(cycles - n, watch)
+                continue
+            period = idle.get(head)
+            if period is not None and arrival == (head, n - period):
+                skip = (cycles - n) // period * period
+                n += skip
+                self.cycles += skip
+                self.skipped += skip
+                n += execute(cycles - n, stops)
+                break
+            if period is not None:
+                arrival = (head, n)
+            n += execute(1, stops)
+            n += execute(cycles - n, watch)
+        return n
+
+    def execute(self, cycles, stops):
+        """Runs the instructions themselves; see run."""
+        code = self.code
+        ram = self.ram
+        a = self.A
+        d = self.D
+        pc = self.PC
+        n = 0
+        while n < cycles and pc not in stops:
+            n += 1
+            ins = code[pc]
+            if ins.__class__ is int:
+                a = ins
+                pc = (pc + 1) & 0x7FFF
+                continue
+
+            comp, usem, dest, jump = ins
+            out = comp(d, ram[a & 0x7FFF] if usem else a)
+            target = a
+            if dest & 1:
+                ram[a & 0x7FFF] = out
+            if dest & 2:
+                d = out
+            if dest & 4:
+                a = out
+
+            if jump and (
+                (jump & 4 and out & 0x8000)
+                or (jump & 2 and out == 0)
+                or (jump & 1 and out and not out & 0x8000)
+            ):
+                pc = target & 0x7FFF
+            else:
+                pc = (pc + 1) & 0x7FFF
+
+        self.A = a
+        self.D = d
+        self.PC = pc
+        self.cycles += n
+        return n
+
+    def executeCounted(self, cycles, stops):
+        """execute, also updating self.counters."""
+        code = self.code
+        ram = self.ram
+        counters = self.counters
+        reads = counters.reads
+        writes = counters.writes
+        executed = counters.executed
+        spmax = counters.spmax
+        a = self.A
+        d = self.D
+        pc = self.PC
+        n = 0
+        while n < cycles and pc not in stops:
+            n += 1
+            executed[pc] += 1
+            ins = code[pc]
+            if ins.__class__ is int:
+                a = ins
+                pc = (pc + 1) & 0x7FFF
+                continue
+
+            comp, usem, dest, jump = ins
+            address = a & 0x7FFF
+            if usem:
+                reads[address] += 1
+            out = comp(d, ram[address] if usem else a)
+            target = a
+            if dest & 1:
+                ram[address] = out
+                writes[address] += 1
+                if address == 0 and out > spmax:
+                    spmax = out
+            if dest & 2:
+                d = out
+            if dest & 4:
+                a = out
+
+            if jump and (
+                (jump & 4 and out & 0x8000)
+                or (jump & 2 and out == 0)
+                or (jump & 1 and out and not out & 0x8000)
+            ):
+                pc = target & 0x7FFF
+            else:
+                pc = (pc + 1) & 0x7FFF
+
+        counters.spmax = spmax
+        self.A = a
+        self.D = d
+        self.PC = pc
+        self.cycles += n
+        return n
+
+    def executeTraced(self, cycles, stops, records):
+        """execute, appending a tracer.py record per cycle to `records`."""
+        code = self.code
+        ram = self.ram
+        a = self.A
+        d = self.D
+        pc = self.PC
+        n = 0
+        while n < cycles and pc not in stops:
+            n += 1
+            ins = code[pc]
+            if ins.__class__ is int:
+                a = ins
+                pc = (pc + 1) & 0x7FFF
+                records.append(0)
+                continue
+
+            comp, usem, dest, jump = ins
+            address = a & 0x7FFF
+            out = comp(d, ram[address] if usem else a)
+            target = a
+            if dest & 1:
+                ram[address] = out
+            if dest & 2:
+                d = out
+            if dest & 4:
+                a = out
+
+            if jump and (
+                (jump & 4 and out & 0x8000)
+                or (jump & 2 and out == 0)
+                or (jump & 1 and out and not out & 0x8000)
+            ):
+                after = target & 0x7FFF
+            else:
+                after = (pc + 1) & 0x7FFF
+
+            delta = after - pc - 1
+            v = (delta << 2 if delta >= 0 else (-delta << 2) - 2) | (dest & 1)
+            if v < 0x80:
+                records.append(v)
+            else:
+                putVarint(records, v)
+            if dest & 1:
+                putVarint(records, address)
+                putVarint(records, out)
+            pc = after
+
+        self.A = a
+        self.D = d
+        self.PC = pc
+        self.cycles += n
+        return n
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a Hack program")
+    parser.add_argument("path", help="a .asm or .hack file")
+    parser.add_argument("cycles", nargs="?", type=int, default=1000)
+    parser.add_argument(
+        "--counters", metavar="FILE", help="write access counters to a .json or .csv"
+    )
+    parser.add_argument(
+        "--trace", metavar="FILE", help="record a trace for tracer.py, stopping at halt"
+    )
+    parser.add_argument(
+        "--interval", type=int, default=65536, help="cycles between trace snapshots"
+    )
+    parser.add_argument("--map", help="the program's vm.py --map, kept in the trace")
+    args = parser.parse_args()
+
+    emulator = Emulator()
+    emulator.load(args.path)
+    if args.counters:
+        emulator.enableCounters()
+    if args.trace:
+        emulator.startTrace(args.interval)
+        emulator.run(args.cycles, emulator.haltAddresses())
+    else:
+        emulator.run(args.cycles)
+    if args.counters:
+        emulator.counters.write(args.counters, emulator.rom, emulator.symbols)
+    if args.trace:
+        sourcemap = None
+        if args.map:
+            with open(args.map) as f:
+                sourcemap = json.load(f)
+        emulator.trace.save(args.trace, sourcemap)
+    print(f"PC={emulator.PC} A={signed(emulator.A)} D={signed(emulator.D)}")
+    print(f"{emulator.cycles} cycles, {emulator.skipped} fast-forwarded")
+    for i in range(16):
+        print(f"RAM[{i}] = {emulator.peek(i)}")
+
+
+if __name__ == "__main__":
+    main()
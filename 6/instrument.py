@@ -0,0 +1,136 @@
+"""
+Counters for Emulator.enableCounters: reads and writes per RAM address,
+executions per ROM address and the stack pointer's high-water mark, with
+summaries by memory segment and by instruction, exported as JSON or CSV.
+"""
+
+from array import array
+import csv
+import json
+import re
+
+from assembler import Code
+
+RAM_SIZE = 32768
+ROM_SIZE = 32768
+
+# Name, first address, end address, following the VM's memory layout
+SEGMENTS = [
+    ("pointers", 0, 5),
+    ("temp", 5, 13),
+    ("scratch", 13, 16),
+    ("static", 16, 256),
+    ("stack", 256, 2048),
+    ("heap", 2048, 16384),
+    ("screen", 16384, 24576),
+    ("keyboard", 24576, 24577),
+]
+
+STATIC = re.compile(r"^[^.]+\.\d+$")
+
+CODE = Code()
+COMP_NAMES = {int(bits, 2): name for name, bits in CODE.comp_table.items() if name}
+JUMP_NAMES = {int(bits, 2): name for name, bits in CODE.jump_table.items()}
+
+
+def segment(address):
+    for name, start, end in SEGMENTS:
+        if start <= address < end:
+            return name
+    return "unmapped"
+
+
+def mnemonic(word):
+    """Names an instruction by its dest, comp and jump, eg M=D+M or D;JGT."""
+    if not word & 0x8000:
+        return "@value"
+    comp = COMP_NAMES.get((word >> 6) & 0b1111111, "?")
+    dest = "".join(r for r, bit in (("A", 4), ("D", 2), ("M", 1)) if word >> 3 & bit)
+    jump = JUMP_NAMES[word & 0b111]
+    return (f"{dest}=" if dest else "") + comp + (f";{jump}" if jump else "")
+
+
+class Counters:
+    def __init__(self):
+        self.reads = array("Q", bytes(8 * RAM_SIZE))
+        self.writes = array("Q", bytes(8 * RAM_SIZE))
+        self.executed = array("Q", bytes(8 * ROM_SIZE))
+        self.spmax = 0
+
+    def segments(self):
+        totals = {}
+        for name, start, end in SEGMENTS:
+            totals[name] = {
+                "reads": sum(self.reads[start:end]),
+                "writes": sum(self.writes[start:end]),
+            }
+        return totals
+
+    def stackTop(self):
+        """Highest stack address written, or None if the stack was never used."""
+        for address in range(2047, 255, -1):
+            if self.writes[address]:
+                return address
+        return None
+
+    def opcodeMix(self, rom):
+        mix = {}
+        for pc, word in enumerate(rom):
+            if self.executed[pc]:
+                name = mnemonic(word)
+                mix[name] = mix.get(name, 0) + self.executed[pc]
+        return dict(sorted(mix.items(), key=lambda item: -item[1]))
+
+    def hottest(self, symbols, n=20):
+        """The n most accessed addresses, with the static each one holds."""
+        # Labels are ROM addresses, so only vm.py's File.i statics name RAM
+        statics = {
+            address: symbol for symbol, address in symbols.items() if STATIC.match(symbol)
+        }
+        total = sorted(
+            ((self.reads[i] + self.writes[i], i) for i in range(RAM_SIZE)), reverse=True
+        )
+        return [
+            {
+                "address": i,
+                "static": statics.get(i),
+                "segment": segment(i),
+                "reads": self.reads[i],
+                "writes": self.writes[i],
+            }
+            for count, i in total[:n]
+            if count
+        ]
+
+    def summary(self, rom, symbols=None):
+        top = self.stackTop()
+        return {
+            "instructions": sum(self.executed),
+            "segments": self.segments(),
+            "stack": {
+                "sp_max": self.spmax,
+                "top": top,
+                "depth": None if top is None else top - 255,
+            },
+            "opcodes": self.opcodeMix(rom),
+            "hottest": self.hottest(symbols or {}),
+        }
+
+    def writeJSON(self, path, rom, symbols=None):
+        with open(path, "w") as f:
+            json.dump(self.summary(rom, symbols), f, indent=2)
+
+    def writeCSV(self, path):
+        """One row per RAM address that was touched."""
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["address", "segment", "reads", "writes"])
+            for i in range(RAM_SIZE):
+                if self.reads[i] or self.writes[i]:
+                    writer.writerow([i, segment(i), self.reads[i], self.writes[i]])
+
+    def write(self, path, rom, symbols=None):
+        if path.endswith(".csv"):
+            self.writeCSV(path)
+        else:
+            self.writeJSON(path, rom, symbols)
@@ -0,0 +1,193 @@
+import argparse
+from array import array
+import json
+import os
+import sys
+
+from assembler import ROM_SIZE, Assembler, AssemblerError, Parser, SymbolTable
+
+
+class ObjectFile:
+    """
+    One module assembled on its own. A-instructions naming one of the
+    module's labels hold the module-relative address and are listed in
+    `relocs`; other symbolic A-instructions hold 0 and are listed in `refs`
+    with the symbol, in code order, for the linker to resolve.
+    """
+
+    def __init__(self, name, code=None, labels=None, relocs=None, refs=None):
+        self.name = name
+        self.code = array("H") if code is None else array("H", code)
+        self.labels = {} if labels is None else labels
+        self.relocs = [] if relocs is None else relocs
+        self.refs = [] if refs is None else refs
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(
+                {
+                    "name": self.name,
+                    "code": self.code.tolist(),
+                    "labels": self.labels,
+                    "relocs": self.relocs,
+                    "refs": self.refs,
+                },
+                f,
+            )
+
+
+def loadObject(path):
+    with open(path) as f:
+        data = json.load(f)
+    return ObjectFile(
+        data["name"],
+        data["code"],
+        data["labels"],
+        data["relocs"],
+        [tuple(ref) for ref in data["refs"]],
+    )
+
+
+def assembleObject(filepath, source=None):
+    assembler = Assembler(filepath, source=source)
+    commands = assembler.parse()
+    if assembler.diagnostics:
+        raise AssemblerError(assembler.diagnostics)
+
+    A_COMMAND = Parser.CommandType.A_COMMAND
+    table = assembler.symboltable
+    labels = {name: table.getAddress(name) for name in assembler.labellines}
+    name = os.path.splitext(os.path.basename(filepath or "<source>"))[0]
+    obj = ObjectFile(name, labels=labels)
+    for offset, command in enumerate(commands):
+        word = 0
+        if command[0] is A_COMMAND:
+            _, word, id = command
+            if id is not None:
+                symbol = table.names[id]
+                if symbol in labels:
+                    word = labels[symbol]
+                    obj.relocs.append(offset)
+                elif symbol in SymbolTable.PREDEFINED:
+                    word = SymbolTable.PREDEFINED[symbol]
+                else:
+                    word = 0
+                    obj.refs.append((offset, symbol))
+        else:
+            word = int(assembler.encodeC(*command[1:]), 2)
+        obj.code.append(word)
+    return obj
+
+
+def link(objects):
+    """
+    Places the objects one after another and patches every reference.
+    A module's own labels win over other modules', so generated labels
+    may repeat across modules; a reference to a label defined in several
+    other modules is an error. Remaining symbols are variables, given RAM
+    16 onwards in order of first use, exactly as the assembler does for a
+    single file. Returns the code words and the symbol table.
+    """
+    bases = []
+    exported = {}
+    ambiguous = set()
+    base = 0
+    for obj in objects:
+        bases.append(base)
+        for label, offset in obj.labels.items():
+            if label in exported:
+                ambiguous.add(label)
+            exported[label] = base + offset
+        base += len(obj.code)
+    if base > ROM_SIZE:
+        raise ValueError(f"Program too large for ROM: {base} words")
+
+    words = array("H")
+    variables = {}
+    nextram = 16
+    errors = []
+    for obj, base in zip(objects, bases):
+        code = array("H", obj.code)
+        for offset in obj.relocs:
+            code[offset] += base
+        for offset, symbol in obj.refs:
+            if symbol in ambiguous:
+                errors.append(f"{obj.name}: '{symbol}' is defined in several modules")
+                continue
+            address = exported.get(symbol)
+            if address is None:
+                address = variables.get(symbol)
+            if address is None:
+                address = variables[symbol] = nextram
+                nextram += 1
+            code[offset] = address
+        words.extend(code)
+    if errors:
+        raise ValueError("\n".join(errors))
+
+    symbols = dict(SymbolTable.PREDEFINED)
+    symbols.update(
+        (label, address) for label, address in exported.items() if label not in ambiguous
+    )
+    symbols.update(variables)
+    return words, symbols
+
+
+def objectPath(asmpath):
+    return os.path.splitext(asmpath)[0] + ".obj"
+
+
+def build(asmpaths):
+    """
+    Returns an object per .asm file, reassembling only those whose object
+    is missing or older than the source, and how many that was.
+    """
+    objects = []
+    rebuilt = 0
+    for path in asmpaths:
+        objpath = objectPath(path)
+        if (
+            os.path.exists(objpath)
+            and os.path.getmtime(objpath) >= os.path.getmtime(path)
+        ):
+            objects.append(loadObject(objpath))
+        else:
+            obj = assembleObject(path)
+            obj.save(objpath)
+            objects.append(obj)
+            rebuilt += 1
+    return objects, rebuilt
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Assemble modules separately and link them into one .hack"
+    )
+    parser.add_argument("writepath")
+    parser.add_argument("modules", nargs="+", help=".asm files, in ROM order")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    try:
+        objects, rebuilt = build(args.modules)
+        words, symbols = link(objects)
+    except AssemblerError as e:
+        for diagnostic in e.diagnostics:
+            print(diagnostic, file=sys.stderr)
+        sys.exit(1)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    with open(args.writepath, "w") as f:
+        for word in words:
+            f.write(bin(word)[2:].zfill(16) + "\n")
+    if args.verbose:
+        print(
+            f"{rebuilt} of {len(objects)} modules assembled, {len(words)} words",
+            file=sys.stderr,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Native versions of Jack OS functions for the CPU and VM emulators. Each
+takes the machine's RAM, the arguments as 16-bit words and a per-machine
+state dict, and returns the 16-bit result, or None to run the real code
+instead, eg for a division by zero, which the OS reports itself.
+"""
+
+SCREEN = 16384
+SCREEN_WORDS = 8192
+SCREEN_WIDTH = 512
+SCREEN_HEIGHT = 256
+
+
+def signed(value):
+    return value - 0x10000 if value & 0x8000 else value
+
+
+def multiply(ram, args, state):
+    x, y = args
+    return (signed(x) * signed(y)) & 0xFFFF
+
+
+def divide(ram, args, state):
+    x, y = map(signed, args)
+    if y == 0:
+        return None
+    # Jack division truncates towards zero
+    q = abs(x) // abs(y)
+    return (q if (x < 0) == (y < 0) else -q) & 0xFFFF
+
+
+def sqrt(ram, args, state):
+    x = signed(args[0])
+    if x < 0:
+        return None
+    r = 0
+    while (r + 1) * (r + 1) <= x:
+        r += 1
+    return r
+
+
+def absolute(ram, args, state):
+    return abs(signed(args[0])) & 0xFFFF
+
+
+def minimum(ram, args, state):
+    return min(args, key=signed)
+
+
+def maximum(ram, args, state):
+    return max(args, key=signed)
+
+
+def peek(ram, args, state):
+    return ram[args[0] & 0x7FFF]
+
+
+def poke(ram, args, state):
+    ram[args[0] & 0x7FFF] = args[1]
+    return 0
+
+
+def setColor(ram, args, state):
+    # Only watches the color: the OS code still runs and keeps its own
+    # static up to date for drawing functions that are not native
+    state["color"] = args[0] != 0
+    return None
+
+
+def fillRow(ram, y, x1, x2, color):
+    """Sets or clears pixels x1..x2 of row y, a word at a time."""
+    row = SCREEN + y * 32
+    for word in range(x1 // 16, x2 // 16 + 1):
+        lo = max(x1, word * 16) - word * 16
+        hi = min(x2, word * 16 + 15) - word * 16
+        mask = ((1 << (hi + 1)) - 1) ^ ((1 << lo) - 1)
+        if color:
+            ram[row + word] |= mask
+        else:
+            ram[row + word] &= ~mask & 0xFFFF
+
+
+def drawPixel(ram, args, state):
+    x, y = map(signed, args)
+    if not (0 <= x < SCREEN_WIDTH and 0 <= y < SCREEN_HEIGHT):
+        return None
+    fillRow(ram, y, x, x, state.get("color", True))
+    return 0
+
+
+def drawRectangle(ram, args, state):
+    x1, y1, x2, y2 = map(signed, args)
+    if not (0 <= x1 <= x2 < SCREEN_WIDTH and 0 <= y1 <= y2 < SCREEN_HEIGHT):
+        return None
+    color = state.get("color", True)
+    for y in range(y1, y2 + 1):
+        fillRow(ram, y, x1, x2, color)
+    return 0
+
+
+def clearScreen(ram, args, state):
+    ram[SCREEN : SCREEN + SCREEN_WORDS] = type(ram)("H", bytes(2 * SCREEN_WORDS))
+    return 0
+
+
+# Function label: (number of arguments, implementation)
+BUILTINS = {
+    "Math.multiply": (2, multiply),
+    "Math.divide": (2, divide),
+    "Math.sqrt": (1, sqrt),
+    "Math.abs": (1, absolute),
+    "Math.min": (2, minimum),
+    "Math.max": (2, maximum),
+    "Memory.peek": (1, peek),
+    "Memory.poke": (2, poke),
+    "Screen.setColor": (1, setColor),
+    "Screen.drawPixel": (2, drawPixel),
+    "Screen.drawRectangle": (4, drawRectangle),
+    "Screen.clearScreen": (0, clearScreen),
+}
+
+# The OS keeps the drawing color in a static of its own, which native
+# drawing cannot see, so these need Screen.setColor watched as well
+NEEDS_COLOR = {"Screen.drawPixel", "Screen.drawRectangle"}
+
+
+def selectBuiltins(names=None):
+    """Returns {label: builtin} for the given names, all of them by default."""
+    names = set(BUILTINS if names is None else names)
+    unknown = names - BUILTINS.keys()
+    if unknown:
+        raise ValueError(f"Unknown builtin: {', '.join(sorted(unknown))}")
+    if names & NEEDS_COLOR:
+        names.add("Screen.setColor")
+    return {name: BUILTINS[name] for name in names}
@@ -0,0 +1,388 @@
+"""
+Compact execution traces for Emulator.startTrace. Each cycle is one record:
+the PC's change from sequential as a zigzag varint, shifted left once with
+a flag set when the instruction wrote memory, then that address and value
+as varints. A straight-line instruction that writes nothing is one zero
+byte. Full snapshots every `interval` cycles, and whenever the state was
+changed between runs, let a reader reach any cycle from the nearest one.
+A and D are not traced; only the PC and RAM can be replayed.
+"""
+
+import argparse
+from array import array
+from bisect import bisect_right
+from itertools import zip_longest
+import json
+import struct
+import sys
+import zlib
+
+from instrument import RAM_SIZE, STATIC
+
+MAGIC = b"HTRC"
+VERSION = 1
+# magic, version, snapshot interval, cycles, snapshots, metadata bytes
+HEADER = struct.Struct("<4sHIQII")
+# cycle, record offset, PC, compressed Emulator.snapshot bytes
+SNAPSHOT = struct.Struct("<QQHI")
+
+# SP and R13-R15 when comparing builds, and where variables other than
+# statics live
+IGNORED = {0, 13, 14, 15}
+VARIABLES = (16, 256)
+STACK = (256, 2048)
+# Prefix of the labels vm.py makes up, return addresses among them
+GENERATED = "$L"
+
+
+def putVarint(buf, n):
+    while n >= 0x80:
+        buf.append(n & 0x7F | 0x80)
+        n >>= 7
+    buf.append(n)
+
+
+def getVarint(data, offset):
+    n = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        n |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return n, offset
+        shift += 7
+
+
+def decode(data, offset, pc, count=None):
+    """
+    Yields (pc, next pc, written address or None, value) per record from
+    `offset`, given the PC before the first one.
+    """
+    end = len(data)
+    n = 0
+    while offset < end and (count is None or n < count):
+        n += 1
+        v = data[offset]
+        offset += 1
+        if v >= 0x80:
+            v, offset = getVarint(data, offset - 1)
+        zz = v >> 1
+        delta = -(zz + 1 >> 1) if zz & 1 else zz >> 1
+        after = (pc + 1 + delta) & 0x7FFF
+        if v & 1:
+            address, offset = getVarint(data, offset)
+            value, offset = getVarint(data, offset)
+            yield pc, after, address, value
+        else:
+            yield pc, after, None, 0
+        pc = after
+
+
+class Recorder:
+    """Collects an emulator's trace; Emulator.run hands its work to run."""
+
+    def __init__(self, emulator, interval=65536):
+        self.emulator = emulator
+        self.interval = interval
+        self.records = bytearray()
+        self.cycles = 0
+        # (cycle, record offset, PC, compressed emulator snapshot)
+        self.snapshots = []
+        self.shadow = None
+        self.takeSnapshot()
+
+    def takeSnapshot(self):
+        blob = self.emulator.snapshot()
+        self.snapshots.append(
+            (self.cycles, len(self.records), self.emulator.PC, zlib.compress(blob))
+        )
+        self.shadow = blob
+
+    def run(self, cycles, stops):
+        emulator = self.emulator
+        # Script sets and snapshot restores happen outside of any cycle
+        if emulator.snapshot() != self.shadow:
+            self.takeSnapshot()
+        n = 0
+        while n < cycles:
+            since = self.cycles - self.snapshots[-1][0]
+            chunk = min(cycles - n, self.interval - since)
+            m = emulator.executeTraced(chunk, stops, self.records)
+            n += m
+            self.cycles += m
+            if self.cycles - self.snapshots[-1][0] >= self.interval:
+                self.takeSnapshot()
+            if m < chunk:
+                break
+        self.shadow = emulator.snapshot()
+        return n
+
+    def save(self, path, sourcemap=None):
+        emulator = self.emulator
+        meta = json.dumps(
+            {
+                "digest": emulator.digest,
+                "symbols": emulator.symbols,
+                "sourcemap": sourcemap,
+            }
+        ).encode()
+        with open(path, "wb") as f:
+            f.write(
+                HEADER.pack(
+                    MAGIC,
+                    VERSION,
+                    self.interval,
+                    self.cycles,
+                    len(self.snapshots),
+                    len(meta),
+                )
+            )
+            f.write(meta)
+            for cycle, offset, pc, blob in self.snapshots:
+                f.write(SNAPSHOT.pack(cycle, offset, pc, len(blob)))
+            for *_, blob in self.snapshots:
+                f.write(blob)
+            f.write(self.records)
+
+
+class Trace:
+    def __init__(self, interval, cycles, snapshots, records, meta):
+        self.interval = interval
+        self.cycles = cycles
+        self.snapshots = snapshots
+        self.records = records
+        self.digest = meta.get("digest")
+        self.symbols = meta.get("symbols") or {}
+        self.sourcemap = meta.get("sourcemap")
+        self.starts = [cycle for cycle, *_ in snapshots]
+
+    def location(self, pc):
+        if self.sourcemap is None or pc >= len(self.sourcemap):
+            return None
+        return self.sourcemap[pc]
+
+    def snapshotBefore(self, cycle):
+        """The last snapshot at or before `cycle`: a binary search."""
+        return self.snapshots[bisect_right(self.starts, cycle) - 1]
+
+    def seek(self, cycle):
+        """Returns the PC and a copy of RAM after `cycle` cycles."""
+        if not 0 <= cycle <= self.cycles:
+            raise ValueError(f"Cycle {cycle} is outside the trace (0-{self.cycles})")
+        start, offset, pc, blob = self.snapshotBefore(cycle)
+        ram = array("H")
+        ram.frombytes(zlib.decompress(blob)[-2 * RAM_SIZE :])
+        for pc, after, address, value in decode(
+            self.records, offset, pc, cycle - start
+        ):
+            if address is not None:
+                ram[address] = value
+            pc = after
+        return pc, ram
+
+    def cycleAt(self, offset):
+        """
+        The cycle whose record holds byte `offset`, and the PC it ran at,
+        which is None past the end of the trace.
+        """
+        if offset >= len(self.records):
+            return self.cycles, None
+        i = bisect_right([start for _, start, *_ in self.snapshots], offset) - 1
+        cycle, position, pc, _ = self.snapshots[i]
+        for pc, after, _, _ in decode(self.records, position, pc):
+            position = self.recordEnd(position)
+            if position > offset:
+                return cycle, pc
+            cycle += 1
+            pc = after
+        return cycle, pc
+
+    def recordEnd(self, offset):
+        v, offset = getVarint(self.records, offset)
+        if v & 1:
+            _, offset = getVarint(self.records, offset)
+            _, offset = getVarint(self.records, offset)
+        return offset
+
+    def replay(self):
+        """
+        Yields (cycle, pc, written address or None, value) for the whole
+        trace, picking the PC up from each snapshot in case it was set.
+        """
+        bounds = self.starts[1:] + [self.cycles]
+        for (cycle, offset, pc, _), end in zip(self.snapshots, bounds):
+            for pc, _, address, value in decode(self.records, offset, pc, end - cycle):
+                yield cycle, pc, address, value
+                cycle += 1
+
+    def events(self):
+        """
+        Yields (cycle, pc, event) per visit to a VM location: the location
+        and the final value of each address written there, statics named.
+        SP, the scratch registers and other variables are left out, as
+        builds may legitimately differ in them, and return addresses pushed
+        on the stack become the location they return to.
+        """
+        statics = {
+            address: name for name, address in self.symbols.items() if STATIC.match(name)
+        }
+        labels = {
+            address for name, address in self.symbols.items() if name.startswith(GENERATED)
+        }
+        sourcemap = self.sourcemap
+        visit = None
+        for cycle, pc, address, value in self.replay():
+            location = sourcemap[pc] if pc < len(sourcemap) else None
+            if visit is None or location != visit[2]:
+                if visit is not None:
+                    yield visit[0], visit[1], (visit[2], sorted(visit[3].items()))
+                visit = (cycle, pc, location, {})
+            if address is None or address in IGNORED:
+                continue
+            if address in statics:
+                visit[3][statics[address]] = value
+            elif (
+                STACK[0] <= address < STACK[1]
+                and value in labels
+                and self.location(value - 1) == location
+            ):
+                # A call pushing the address just past its own code
+                visit[3][address] = self.location(value)
+            elif not VARIABLES[0] <= address < VARIABLES[1]:
+                visit[3][address] = value
+        if visit is not None:
+            yield visit[0], visit[1], (visit[2], sorted(visit[3].items()))
+
+
+def load(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version, interval, cycles, nsnapshots, metasize = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path} is not a version {VERSION} trace")
+    offset = HEADER.size
+    meta = json.loads(data[offset : offset + metasize])
+    offset += metasize
+    table = []
+    for _ in range(nsnapshots):
+        table.append(SNAPSHOT.unpack_from(data, offset))
+        offset += SNAPSHOT.size
+    snapshots = []
+    for cycle, recordoffset, pc, size in table:
+        snapshots.append((cycle, recordoffset, pc, data[offset : offset + size]))
+        offset += size
+    return Trace(interval, cycles, snapshots, data[offset:], meta)
+
+
+def firstDifference(a, b, chunk=65536):
+    """The first offset at which two byte strings differ, or None."""
+    end = min(len(a), len(b))
+    start = 0
+    while start < end and a[start : start + chunk] == b[start : start + chunk]:
+        start += chunk
+    for i in range(start, min(start + chunk, end)):
+        if a[i] != b[i]:
+            return i
+    return None if len(a) == len(b) else end
+
+
+def bisectSame(a, b):
+    """
+    Both traces ran the same ROM, so their records line up cycle by cycle
+    up to the first difference. Where a script changed the state between
+    runs, the snapshots taken there must agree too.
+    """
+    offset = firstDifference(a.records, b.records)
+    cycle = None if offset is None else a.cycleAt(offset)[0]
+    for start in sorted(set(a.starts) | set(b.starts)):
+        if cycle is not None and start > cycle or start > min(a.cycles, b.cycles):
+            break
+        pa, ram_a = a.seek(start)
+        pb, ram_b = b.seek(start)
+        if pa != pb or ram_a != ram_b:
+            return start, pa, start, pb
+    if cycle is None:
+        return None
+    return a.cycleAt(offset) + b.cycleAt(offset)
+
+
+def bisectEvents(a, b):
+    """
+    Different ROMs, eg before and after a change to vm.py: compares the VM
+    locations each trace passes through and the writes made at each.
+    """
+    for event_a, event_b in zip_longest(a.events(), b.events()):
+        if event_a is None or event_b is None or event_a[2] != event_b[2]:
+            ca, pa = (a.cycles, None) if event_a is None else event_a[:2]
+            cb, pb = (b.cycles, None) if event_b is None else event_b[:2]
+            return ca, pa, cb, pb
+    return None
+
+
+def formatPC(trace, pc):
+    if pc is None:
+        return "end of trace"
+    location = trace.location(pc)
+    return f"PC={pc}" + (f" ({location})" if location else "")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay and compare traces written by emulator.py or tst.py --trace"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    replay = commands.add_parser("replay", help="show the state after a cycle")
+    replay.add_argument("trace")
+    replay.add_argument("cycle", type=int)
+    replay.add_argument(
+        "--ram", metavar="FROM:TO", default="0:16", help="RAM range to print"
+    )
+
+    compare = commands.add_parser("bisect", help="find where two traces diverge")
+    compare.add_argument("a")
+    compare.add_argument("b")
+    compare.add_argument(
+        "--maps",
+        nargs=2,
+        metavar=("MAP_A", "MAP_B"),
+        help="vm.py --map files, for traces recorded without them",
+    )
+    args = parser.parse_args()
+
+    if args.command == "replay":
+        trace = load(args.trace)
+        try:
+            pc, ram = trace.seek(args.cycle)
+        except ValueError as e:
+            parser.error(str(e))
+        start, end = (int(n) for n in args.ram.split(":"))
+        print(formatPC(trace, pc))
+        for address in range(start, end):
+            value = ram[address]
+            print(f"RAM[{address}] = {value - 0x10000 if value & 0x8000 else value}")
+    else:
+        a = load(args.a)
+        b = load(args.b)
+        if args.maps:
+            for trace, path in zip((a, b), args.maps):
+                with open(path) as f:
+                    trace.sourcemap = json.load(f)
+        if a.digest == b.digest:
+            found = bisectSame(a, b)
+        elif a.sourcemap is None or b.sourcemap is None:
+            parser.error("traces of different programs need source maps to compare")
+        else:
+            found = bisectEvents(a, b)
+        if found is None:
+            print("no divergence")
+            return
+        ca, pa, cb, pb = found
+        print(f"{args.a}: cycle {ca}, {formatPC(a, pa)}")
+        print(f"{args.b}: cycle {cb}, {formatPC(b, pb)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
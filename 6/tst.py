@@ -0,0 +1,341 @@
+import argparse
+import os
+import re
+import sys
+
+from emulator import Emulator, signed
+from native import BUILTINS
+
+TOKEN = re.compile(r"[{},;]|[^\s{},;]+")
+OUTPUT_SPEC = re.compile(r"^(.+?)(?:%([BDXS])(\d+)\.(\d+)\.(\d+))?$")
+RAM_NAME = re.compile(r"^RAM\[(\d+)\]$")
+
+# Post-boot machine state and its cycle count, keyed by ROM digest and the
+# script's initial sets
+BOOT_CACHE = {}
+
+
+def stripComments(text):
+    text = re.sub(r"/\*.*?\*/", "", text, flags=re.S)
+    return re.sub(r"//[^\n]*", "", text)
+
+
+def parseScript(text):
+    """
+    Parses a test script into a list of commands. Each command is a list of
+    words, except `repeat` which becomes ["repeat", count, body].
+    """
+    tokens = TOKEN.findall(stripComments(text))
+    pos = 0
+
+    def block():
+        nonlocal pos
+        commands = []
+        words = []
+        while pos < len(tokens):
+            token = tokens[pos]
+            pos += 1
+            if token in (",", ";"):
+                if words:
+                    commands.append(words)
+                words = []
+            elif token == "{":
+                pos_words = words
+                words = []
+                body = block()
+                if pos_words[0] == "repeat":
+                    count = int(pos_words[1]) if len(pos_words) > 1 else -1
+                    commands.append(["repeat", count, body])
+                else:
+                    commands.append([*pos_words, body])
+            elif token == "}":
+                break
+            else:
+                words.append(token)
+        if words:
+            commands.append(words)
+        return commands
+
+    return block()
+
+
+def parseOutputSpec(spec):
+    name, fmt, left, width, right = OUTPUT_SPEC.match(spec).groups()
+    if fmt is None:
+        return (name, "D", 1, 6, 1)
+    return (name, fmt, int(left), int(width), int(right))
+
+
+def formatValue(value, fmt, width):
+    if fmt == "B":
+        text = bin(value & 0xFFFF)[2:].zfill(16)[-width:]
+    elif fmt == "X":
+        text = hex(value & 0xFFFF)[2:].upper().zfill(4)[-width:]
+    elif fmt == "S":
+        text = str(value)[:width]
+        return text.ljust(width)
+    else:
+        text = str(signed(value & 0xFFFF))
+    return text.rjust(width)
+
+
+def formatHeader(columns):
+    """The output-list header line: each name centered in its column."""
+    cells = []
+    for name, fmt, left, width, right in columns:
+        total = left + width + right
+        name = name[:total]
+        pad = (total - len(name)) // 2
+        cells.append(" " * pad + name + " " * (total - len(name) - pad))
+    return "|" + "|".join(cells) + "|"
+
+
+def matchesCompareFile(outputs, path):
+    # Like the official tools, comparison ignores whitespace
+    with open(path) as f:
+        expected = ["".join(line.split()) for line in f if line.strip()]
+    actual = ["".join(line.split()) for line in outputs]
+    return actual == expected
+
+
+def isTicktockLoop(command):
+    return command[0] == "repeat" and command[2] == [["ticktock"]]
+
+
+class TestScript:
+    def __init__(
+        self, path, emulator=None, stops=None, builtins=None, counters=False, trace=False
+    ):
+        self.path = path
+        self.dir = os.path.dirname(path)
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        with open(path) as f:
+            self.commands = parseScript(f.read())
+        # An emulator passed in already holds the program of the first load
+        self.emulator = emulator
+        self.preloaded = emulator is not None
+        # Addresses at which ticking stops, eg the program's halt loops
+        self.stops = stops
+        self.stopped = False
+        # OS functions to run natively: a list of names, or None for none
+        self.builtins = builtins
+        self.counters = counters
+        self.trace = trace
+        self.outputs = []
+        self.columns = []
+        self.comparepath = None
+        self.sets = []
+        self.booted = False
+        self.credit = 0
+
+    def defaultProgram(self):
+        for candidate in (
+            f"{self.name}.asm",
+            f"{self.name}.hack",
+            "out.asm",
+            "test.asm",
+        ):
+            path = os.path.join(self.dir, candidate)
+            if os.path.exists(path):
+                return path
+        raise FileNotFoundError(f"No program found for {self.path}")
+
+    def programPath(self):
+        for command in self.commands:
+            if command[0] == "load" and len(command) > 1:
+                return os.path.join(self.dir, command[1])
+            elif command[0] == "load":
+                break
+        return self.defaultProgram()
+
+    def load(self, path):
+        self.emulator = Emulator()
+        self.emulator.load(path)
+        if self.builtins is not None:
+            self.emulator.enableBuiltins(self.builtins)
+        if self.counters:
+            self.emulator.enableCounters()
+        if self.trace:
+            self.emulator.startTrace()
+
+    def value(self, name):
+        emulator = self.emulator
+        match = RAM_NAME.match(name)
+        if match:
+            return emulator.ram[int(match.group(1))]
+        elif name == "A":
+            return emulator.A
+        elif name == "D":
+            return emulator.D
+        elif name == "PC":
+            return emulator.PC
+        elif name == "time":
+            return emulator.cycles
+        raise ValueError(f"Unknown output variable: {name}")
+
+    def set(self, name, value):
+        emulator = self.emulator
+        value = int(value) & 0xFFFF
+        match = RAM_NAME.match(name)
+        if match:
+            emulator.ram[int(match.group(1))] = value
+        elif name == "A":
+            emulator.A = value
+        elif name == "D":
+            emulator.D = value
+        elif name == "PC":
+            emulator.PC = value
+        else:
+            raise ValueError(f"Unknown variable: {name}")
+
+    def output(self):
+        cells = []
+        for name, fmt, left, width, right in self.columns:
+            text = formatValue(self.value(name), fmt, width)
+            cells.append(" " * left + text + " " * right)
+        return "|" + "|".join(cells) + "|"
+
+    def boot(self, cycles):
+        """
+        Runs the bootstrap code up to the entry of Sys.init, within the
+        `cycles` budget, reusing the snapshot of an earlier run of the same
+        ROM and initial sets. Only a run that reached Sys.init is kept.
+        """
+        emulator = self.emulator
+        key = (emulator.digest, tuple(self.sets))
+        entry = emulator.symbols["Sys.init"]
+        # A trace or the access counters should see the bootstrap's cycles
+        # themselves, not a restore
+        cacheable = emulator.trace is None and emulator.counters is None
+        cached = BOOT_CACHE.get(key) if cacheable else None
+        if cached is not None and cached[1] <= cycles:
+            emulator.restore(cached[0])
+        else:
+            emulator.run(cycles, until=entry)
+            if cacheable and emulator.PC == entry:
+                BOOT_CACHE[key] = (emulator.snapshot(), emulator.cycles)
+        return emulator.cycles
+
+    def ticktock(self, cycles):
+        if not self.booted:
+            self.booted = True
+            if "Sys.init" in self.emulator.symbols:
+                self.credit = self.boot(cycles)
+        used = min(self.credit, cycles)
+        self.credit -= used
+        if self.stopped:
+            return
+        n = self.emulator.run(cycles - used, until=self.stops)
+        self.stopped = n < cycles - used
+
+    def execute(self, commands):
+        for command in commands:
+            op = command[0]
+            if op != "load" and self.emulator is None:
+                self.load(self.defaultProgram())
+
+            if op == "load" and self.preloaded:
+                self.preloaded = False
+            elif op == "load":
+                path = command[1] if len(command) > 1 else self.defaultProgram()
+                self.load(os.path.join(self.dir, path))
+            elif op == "compare-to":
+                self.comparepath = os.path.join(self.dir, command[1])
+            elif op == "output-list":
+                self.columns = [parseOutputSpec(spec) for spec in command[1:]]
+                self.outputs.append(formatHeader(self.columns))
+            elif op == "output":
+                self.outputs.append(self.output())
+            elif op == "set":
+                if not self.booted:
+                    self.sets.append((command[1], command[2]))
+                self.set(command[1], command[2])
+            elif op == "repeat" and isTicktockLoop(command):
+                self.ticktock(command[1])
+            elif op == "repeat":
+                for _ in range(command[1]):
+                    self.execute(command[2])
+            elif op in ("ticktock", "tock"):
+                self.ticktock(1)
+            elif op in ("tick", "echo", "output-file", "clear-echo"):
+                pass
+            else:
+                raise ValueError(f"Unsupported script command: {op}")
+
+    def run(self):
+        self.execute(self.commands)
+        if self.comparepath is None:
+            return True
+        return matchesCompareFile(self.outputs, self.comparepath)
+
+
+def findScripts(paths):
+    scripts = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.endswith(".tst") and not name.endswith("VME.tst"):
+                        scripts.append(os.path.join(root, name))
+        else:
+            scripts.append(path)
+    return scripts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run .tst scripts on the emulator")
+    parser.add_argument("paths", nargs="+", help="scripts or directories of them")
+    parser.add_argument(
+        "--builtin",
+        action="append",
+        metavar="NAME",
+        help="run an OS function natively, eg Math.multiply",
+    )
+    parser.add_argument(
+        "--builtins", action="store_true", help="run every OS function in native.py natively"
+    )
+    parser.add_argument(
+        "--counters",
+        metavar="DIR",
+        help="write each script's access counters to DIR/<script>.json",
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="DIR",
+        help="record each script's run to DIR/<script>.trace for tracer.py",
+    )
+    args = parser.parse_args()
+    builtins = sorted(BUILTINS) if args.builtins else args.builtin
+    for directory in (args.counters, args.trace):
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    failures = 0
+    for path in findScripts(args.paths):
+        script = TestScript(
+            path,
+            builtins=builtins,
+            counters=bool(args.counters),
+            trace=bool(args.trace),
+        )
+        passed = script.run()
+        if args.counters:
+            emulator = script.emulator
+            emulator.counters.write(
+                os.path.join(args.counters, f"{script.name}.json"),
+                emulator.rom,
+                emulator.symbols,
+            )
+        if args.trace:
+            script.emulator.trace.save(os.path.join(args.trace, f"{script.name}.trace"))
+        failures += not passed
+        status = "PASS" if passed else "FAIL"
+        print(f"{status} {path} ({script.emulator.cycles} cycles)")
+        if not passed:
+            print("\n".join(script.outputs))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
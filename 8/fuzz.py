@@ -0,0 +1,356 @@
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "6"))
+
+from assembler import Assembler
+from batch import RomPack, runBatch
+from emulator import Emulator
+import vm
+from vmemulator import VMEmulator, signed
+
+THIS_BASE = 3000
+THAT_BASE = 4000
+SEGMENT_SIZE = 8
+NSTATICS = 4
+
+OPS_BINARY = ["add", "sub", "and", "or"]
+OPS_UNARY = ["neg", "not"]
+OPS_COMPARE = ["eq", "gt", "lt"]
+
+
+class ProgramGenerator:
+    """
+    Generates random well-formed VM programs: every expression leaves exactly
+    one value on the stack, every statement leaves the stack unchanged,
+    functions only call functions with a higher index so there is no
+    unbounded recursion, and loops count down a dedicated local. A `leaves`
+    share of the functions are small leaves, one shallow statement and no
+    calls, so that -O2 finds bodies within INLINE_BUDGET to inline.
+    """
+
+    def __init__(
+        self, rng, functions=4, depth=3, statements=4, max_const=100, leaves=0.0
+    ):
+        self.rng = rng
+        self.nfunctions = functions
+        self.depth = depth
+        self.statements = statements
+        self.max_const = max_const
+        self.leaves = leaves
+        self.nlabels = 0
+
+    def label(self):
+        self.nlabels += 1
+        return f"L{self.nlabels}"
+
+    def generate(self):
+        self.signatures = [
+            (self.rng.randint(0, 3), self.rng.randint(0, 3))
+            for _ in range(self.nfunctions)
+        ]
+        self.leaf = [self.rng.random() < self.leaves for _ in range(self.nfunctions)]
+        main = []
+        for i in range(self.nfunctions):
+            main.extend(self.function(i))
+
+        sys_vm = [
+            f"function Sys.init {self.depth}",
+            f"push constant {THIS_BASE}",
+            "pop pointer 0",
+            f"push constant {THAT_BASE}",
+            "pop pointer 1",
+        ]
+        self.current = None
+        self.nlocals = 0
+        self.nargs = 0
+        for _ in range(self.statements):
+            sys_vm.extend(self.statement(self.depth))
+        sys_vm.extend(["label END", "goto END"])
+
+        return [("Sys", sys_vm), ("Main", main)]
+
+    def function(self, i):
+        nargs, nlocals = self.signatures[i]
+        self.current = i
+        self.nlocals = nlocals
+        self.nargs = nargs
+        depth, statements = (1, 1) if self.leaf[i] else (self.depth, self.statements)
+        body = []
+        for _ in range(statements):
+            body.extend(self.statement(depth))
+        body.extend(self.expression(depth))
+        body.append("return")
+        return [f"function Main.f{i} {nlocals + depth}", *body]
+
+    def readable(self):
+        segments = [("static", NSTATICS), ("temp", 8), ("this", SEGMENT_SIZE),
+                    ("that", SEGMENT_SIZE), ("pointer", 2)]
+        if self.nlocals:
+            segments.append(("local", self.nlocals))
+        if self.nargs:
+            segments.append(("argument", self.nargs))
+        return segments
+
+    def writable(self):
+        return [seg for seg in self.readable() if seg[0] != "pointer"]
+
+    def callees(self):
+        if self.current is not None and self.leaf[self.current]:
+            return range(0)
+        first = 0 if self.current is None else self.current + 1
+        return range(first, self.nfunctions)
+
+    def expression(self, depth):
+        rng = self.rng
+        kind = rng.choice(["leaf", "leaf", "binary", "unary", "compare", "call"])
+        if depth == 0 or kind == "leaf":
+            if rng.random() < 0.5:
+                return [f"push constant {rng.randint(0, self.max_const)}"]
+            segment, size = rng.choice(self.readable())
+            return [f"push {segment} {rng.randrange(size)}"]
+        elif kind == "binary":
+            return [
+                *self.expression(depth - 1),
+                *self.expression(depth - 1),
+                rng.choice(OPS_BINARY),
+            ]
+        elif kind == "unary":
+            return [*self.expression(depth - 1), rng.choice(OPS_UNARY)]
+        elif kind == "compare":
+            return [
+                *self.expression(depth - 1),
+                *self.expression(depth - 1),
+                rng.choice(OPS_COMPARE),
+            ]
+        callees = self.callees()
+        if not callees:
+            return self.expression(0)
+        callee = rng.choice(callees)
+        nargs = self.signatures[callee][0]
+        asm = []
+        for _ in range(nargs):
+            asm.extend(self.expression(depth - 1))
+        return [*asm, f"call Main.f{callee} {nargs}"]
+
+    def statement(self, depth):
+        rng = self.rng
+        kind = rng.choice(["assign", "assign", "if", "loop"])
+        if depth == 0 or kind == "assign":
+            segment, size = rng.choice(self.writable())
+            return [
+                *self.expression(depth),
+                f"pop {segment} {rng.randrange(size)}",
+            ]
+        elif kind == "if":
+            true_label = self.label()
+            end_label = self.label()
+            return [
+                *self.expression(depth - 1),
+                f"if-goto {true_label}",
+                *self.statement(depth - 1),
+                f"goto {end_label}",
+                f"label {true_label}",
+                *self.statement(depth - 1),
+                f"label {end_label}",
+            ]
+        # The loop counter lives past the locals that statements write, so
+        # the body cannot clobber it
+        counter = ("local", self.nlocals + depth - 1)
+        start = self.label()
+        end = self.label()
+        body = []
+        for _ in range(rng.randint(1, 2)):
+            body.extend(self.statement(depth - 1))
+        return [
+            f"push constant {rng.randint(0, 4)}",
+            f"pop {counter[0]} {counter[1]}",
+            f"label {start}",
+            f"push {counter[0]} {counter[1]}",
+            "push constant 0",
+            "eq",
+            f"if-goto {end}",
+            *body,
+            f"push {counter[0]} {counter[1]}",
+            "push constant 1",
+            "sub",
+            f"pop {counter[0]} {counter[1]}",
+            f"goto {start}",
+            f"label {end}",
+        ]
+
+
+def compile(sources):
+    """vm.py -> assembler -> emulator without leaving the process."""
+    asm = vm.translate(sources)
+    assembler = Assembler(None, source=vm.resolveLabels(asm))
+    words = [int(line, 2) for line in assembler.translate()]
+    symbols = dict(assembler.symboltable.items())
+    return Emulator(words, symbols)
+
+
+def compare(vmemu, cpu):
+    diffs = []
+
+    def check(name, expected, actual):
+        if expected != actual:
+            diffs.append((name, signed(expected), signed(actual)))
+
+    for i, name in enumerate(["SP", "LCL", "ARG", "THIS", "THAT"]):
+        check(name, vmemu.ram[i], cpu.ram[i])
+    for i in range(5, 13):
+        check(f"RAM[{i}]", vmemu.ram[i], cpu.ram[i])
+    # RAM[256] holds the bootstrap return address, which differs by design
+    for i in range(257, max(vmemu.ram[0], cpu.ram[0])):
+        check(f"RAM[{i}]", vmemu.ram[i], cpu.ram[i])
+    for base in (THIS_BASE, THAT_BASE):
+        for i in range(base, base + SEGMENT_SIZE):
+            check(f"RAM[{i}]", vmemu.ram[i], cpu.ram[i])
+    for vm_name in ("Sys", "Main"):
+        for i in range(NSTATICS):
+            symbol = f"{vm_name}.{i}"
+            address = cpu.symbols.get(symbol)
+            actual = cpu.ram[address] if address is not None else 0
+            check(symbol, vmemu.statics.get(symbol, 0), actual)
+    return diffs
+
+
+def fuzzOne(seed, options):
+    rng = random.Random(seed)
+    generator = ProgramGenerator(
+        rng,
+        functions=options["functions"],
+        depth=options["depth"],
+        max_const=options["max_const"],
+        leaves=options["leaves"],
+    )
+    sources = generator.generate()
+
+    vmemu = VMEmulator(sources)
+    vmemu.boot()
+    vmemu.run(options["steps"])
+    if not vmemu.halted():
+        return ("timeout", sources, None, vmemu.steps, 0)
+
+    cpu = compile(sources)
+    cpu.run(options["cycles"], until=cpu.symbols["END"])
+    if cpu.PC != cpu.symbols["END"]:
+        return ("mismatch", sources, [("halt", "END", cpu.PC)], vmemu.steps, cpu.cycles)
+
+    diffs = compare(vmemu, cpu)
+    return ("mismatch" if diffs else "ok", sources, diffs, vmemu.steps, cpu.cycles)
+
+
+def fuzzBatch(job):
+    first, count, options = job
+    vm.OPTIONS.update(options["vm"])
+    results = {"ok": 0, "timeout": 0, "mismatch": 0}
+    failures = []
+    steps = cycles = 0
+    for seed in range(first, first + count):
+        status, sources, diffs, n, c = fuzzOne(seed, options)
+        results[status] += 1
+        steps += n
+        cycles += c
+        if status == "mismatch":
+            failures.append((seed, sources, diffs))
+    return results, failures, steps, cycles
+
+
+def save(directory, seed, sources):
+    path = os.path.join(directory, f"seed{seed}")
+    os.makedirs(path, exist_ok=True)
+    for vm_name, lines in sources:
+        with open(os.path.join(path, f"{vm_name}.vm"), "w") as f:
+            f.write("\n".join(lines) + "\n")
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Differential fuzzing of vm.py against VM semantics"
+    )
+    parser.add_argument("-n", "--count", type=int, default=1000)
+    parser.add_argument("-s", "--seed", type=int, default=0)
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count())
+    parser.add_argument("--batch", type=int, default=50, help="programs per job")
+    parser.add_argument("--functions", type=int, default=4)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--max-const", type=int, default=100)
+    parser.add_argument(
+        "--leaves",
+        type=float,
+        default=0.5,
+        metavar="SHARE",
+        help="share of functions generated as small leaves that -O2 can inline",
+    )
+    parser.add_argument("--steps", type=int, default=100000)
+    parser.add_argument("--cycles", type=int, default=2000000)
+    parser.add_argument("--save", help="directory to write failing programs to")
+    parser.add_argument(
+        "-O", dest="level", choices=sorted(vm.LEVELS), help="vm.py optimization preset"
+    )
+    parser.add_argument(
+        "-o",
+        "--option",
+        action="append",
+        default=[],
+        choices=sorted(vm.OPTIONS),
+        help="vm.py code generation option to enable",
+    )
+    parser.add_argument(
+        "--no-option",
+        action="append",
+        default=[],
+        choices=sorted(vm.OPTIONS),
+        help="vm.py code generation option to disable",
+    )
+    args = parser.parse_args()
+
+    options = {
+        "functions": args.functions,
+        "depth": args.depth,
+        "max_const": args.max_const,
+        "leaves": args.leaves,
+        "steps": args.steps,
+        "cycles": args.cycles,
+        "vm": {
+            **(vm.optimizationLevel(args.level) if args.level is not None else {}),
+            **{name: True for name in args.option},
+            **{name: False for name in args.no_option},
+        },
+    }
+    jobs = [
+        (first, min(args.batch, args.seed + args.count - first), options)
+        for first in range(args.seed, args.seed + args.count, args.batch)
+    ]
+
+    start = time.perf_counter()
+    totals = {"ok": 0, "timeout": 0, "mismatch": 0}
+    steps = cycles = 0
+    for results, failures, n, c in runBatch(jobs, RomPack(), fuzzBatch, args.jobs):
+        for status, count in results.items():
+            totals[status] += count
+        steps += n
+        cycles += c
+        for seed, sources, diffs in failures:
+            where = f" -> {save(args.save, seed, sources)}" if args.save else ""
+            print(f"MISMATCH seed {seed}{where}", flush=True)
+            for name, expected, actual in diffs[:8]:
+                print(f"  {name}: expected {expected}, got {actual}")
+    elapsed = time.perf_counter() - start
+
+    print(
+        f"{sum(totals.values())} programs in {elapsed:.2f}s "
+        f"({sum(totals.values()) / elapsed * 60:,.0f}/min): "
+        f"{totals['ok']} ok, {totals['mismatch']} mismatched, "
+        f"{totals['timeout']} timed out; {steps} VM steps, {cycles} cycles"
+    )
+    sys.exit(1 if totals["mismatch"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import argparse
+import glob
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "6"))
+
+from assembler import Assembler
+from emulator import Emulator
+from tst import TestScript
+import vm
+
+TEST_DIRS = [os.path.join(ROOT, "7"), os.path.join(ROOT, "8", "vm-code")]
+
+
+def testScripts():
+    scripts = []
+    for root in TEST_DIRS:
+        for path in sorted(glob.glob(os.path.join(root, "*", "*.tst"))):
+            if not path.endswith("VME.tst"):
+                scripts.append(path)
+    return scripts
+
+
+def build(directory, options):
+    """Translates a test directory with the given vm.OPTIONS and assembles it."""
+    saved = dict(vm.OPTIONS)
+    vm.OPTIONS.update(options)
+    try:
+        # Directories with a Sys.vm get the bootstrap, like `vm.py dir/`
+        if os.path.exists(os.path.join(directory, "Sys.vm")):
+            asm = vm.translate(vm.readSources(directory))
+        else:
+            (source,) = glob.glob(os.path.join(directory, "*.vm"))
+            asm = vm.translate(vm.readSources(source), sysinit=False)
+    finally:
+        vm.OPTIONS.clear()
+        vm.OPTIONS.update(saved)
+
+    assembler = Assembler(None, source=vm.resolveLabels(asm))
+    words = [int(line, 2) for line in assembler.translate()]
+    return Emulator(words, dict(assembler.symboltable.items()))
+
+
+def measure(path, options):
+    """
+    Runs a test script against a fresh translation. Ticking stops at the
+    program's halt loop, so the cycle count is the time to finish.
+    """
+    emulator = build(os.path.dirname(path), options)
+    script = TestScript(path, emulator, stops=emulator.haltAddresses())
+    passed = script.run()
+    return len(emulator.rom), script.emulator.cycles, passed
+
+
+def delta(before, after):
+    percent = (after - before) / before * 100 if before else 0
+    return f"{after - before:+d} ({percent:+.1f}%)"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare ROM size and cycles with a vm.py option off and on"
+    )
+    parser.add_argument("option", choices=sorted(vm.OPTIONS))
+    parser.add_argument(
+        "--with",
+        dest="others",
+        action="append",
+        default=[],
+        choices=sorted(vm.OPTIONS),
+        help="option enabled in both runs",
+    )
+    args = parser.parse_args()
+
+    base = {name: name in args.others for name in vm.OPTIONS}
+    test = dict(base, **{args.option: True})
+
+    print(f"{'test':<20} {'words':>7} {'delta':>16} {'cycles':>7} {'delta':>16}  result")
+    for path in testScripts():
+        words0, cycles0, passed0 = measure(path, base)
+        words1, cycles1, passed1 = measure(path, test)
+        result = "ok" if passed0 and passed1 else f"FAIL ({passed0}, {passed1})"
+        name = os.path.basename(os.path.dirname(path))
+        print(
+            f"{name:<20} {words1:>7} {delta(words0, words1):>16} "
+            f"{cycles1:>7} {delta(cycles0, cycles1):>16}  {result}"
+        )
+
+
+if __name__ == "__main__":
+    main()
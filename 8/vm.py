@@ -1,6 +1,13 @@
+import argparse
+from array import array
+import json
 import os
 import sys
 import glob
+import time
+
+import vmir
+import vmopt
 
 ARITH_BINARY = {
     "add": ["@SP", "AM=M-1", "D=M", "A=A-1", "M=D+M"],
@@ -28,6 +35,7 @@ SEGLABEL = {
 }
 
 SEGMENTS = {
+    "stack": "stack",
     "local": "pointer",
     "argument": "pointer",
     "this": "pointer",
@@ -39,12 +47,111 @@ SEGMENTS = {
 }
 
 LABEL_NUMBER = 0
+# Prefix of the labels vm.py makes up: "$" is legal in Hack symbols but not
+# in VM identifiers, so no label of the program's own can collide
+GENERATED = "$L"
+
+# Code generation options
+OPTIONS = {
+    # Choose the shortest sequence per segment index and constant value
+    "specialize": True,
+    # Track SP at compile time within basic blocks, writing it back once
+    "spbatch": False,
+    # Expand calls to small functions in place (see vmopt.py)
+    "inline": False,
+    # Turn `call f n; return` into a jump that reuses the caller's frame
+    "tailcall": False,
+    # Drop code after unconditional jumps that no label leads to
+    "deadcode": False,
+    # Jump straight to the final target of jump chains
+    "jumps": False,
+    # Rewrite redundant adjacent instructions
+    "peephole": False,
+}
+
+# Option presets: -O0 is the plain translation, -Os aims at a small ROM and
+# -O2 at few cycles, trading ROM for inlined calls
+LEVELS = {
+    "0": set(),
+    "s": {"specialize", "spbatch", "tailcall", "deadcode", "jumps", "peephole"},
+    "2": set(OPTIONS),
+}
+
+# Commands that end a basic block: control can enter or leave there, so the
+# stack pointer in RAM must be exact around them
+BLOCK_BOUNDARIES = {
+    "label", "goto", "if-goto", "function", "call", "return", "tailcall",
+}
+
+# Words in each command of the VM language, the command itself included
+COMMAND_WORDS = {
+    **{op: 1 for op in (*ARITH_BINARY, *ARITH_UNARY, *ARITH_TEST, "return")},
+    **{op: 2 for op in ("label", "goto", "if-goto")},
+    **{op: 3 for op in ("push", "pop", "function", "call")},
+}
+
+# With spbatch, how far the real stack pointer is from RAM[SP] in the current
+# block, or None while RAM[SP] is kept exact
+SP_OFFSET = None
+MAX_SP_OFFSET = 4
+
+def stackAddress(offset):
+    """Points A at RAM[SP + offset], eg @SP, A=M+1, A=A+1 for offset 2"""
+    if offset == 0:
+        return ["@SP", "A=M"]
+    elif offset > 0:
+        return ["@SP", "A=M+1"] + ["A=A+1"] * (offset - 1)
+    return ["@SP", "A=M-1"] + ["A=A-1"] * (-offset - 1)
+
+def stackTop():
+    if SP_OFFSET is None:
+        return ["@SP", "A=M-1"]
+    return stackAddress(SP_OFFSET - 1)
+
+def flushSP():
+    """Writes the tracked offset back to RAM[SP] and stops tracking."""
+    global SP_OFFSET
+    offset = SP_OFFSET or 0
+    SP_OFFSET = None
+    if offset == 0:
+        return []
+    elif abs(offset) <= 2:
+        return ["@SP"] + ["M=M+1" if offset > 0 else "M=M-1"] * abs(offset)
+    elif offset > 0:
+        return [f"@{offset}", "D=A", "@SP", "M=D+M"]
+    return [f"@{-offset}", "D=A", "@SP", "M=M-D"]
+
+def getPushValue(comp):
+    """Pushes a value the ALU can compute in one step, eg D, 0 or -1."""
+    global SP_OFFSET
+    if SP_OFFSET is None:
+        return ["@SP", "A=M", f"M={comp}", "@SP", "M=M+1"]
+    asm = [*stackAddress(SP_OFFSET), f"M={comp}"]
+    SP_OFFSET += 1
+    return asm
 
 def getPushD():
-    return ["@SP", "A=M", "M=D", "@SP", "M=M+1"]
+    return getPushValue("D")
 
 def getPopD():
-    return ["@SP", "AM=M-1", "D=M"]
+    global SP_OFFSET
+    if SP_OFFSET is None:
+        return ["@SP", "AM=M-1", "D=M"]
+    SP_OFFSET -= 1
+    return [*stackAddress(SP_OFFSET), "D=M"]
+
+def getBinary(op):
+    global SP_OFFSET
+    if SP_OFFSET is None:
+        return ARITH_BINARY[op]
+    asm = [*stackAddress(SP_OFFSET - 1), "D=M", "A=A-1", ARITH_BINARY[op][-1]]
+    SP_OFFSET -= 1
+    return asm
+
+def getUnary(op):
+    if SP_OFFSET is None:
+        return ARITH_UNARY[op]
+    return [*stackTop(), ARITH_UNARY[op][-1]]
 
 def _getPushMem(src):
     return [
@@ -112,12 +219,35 @@ def setPointerToD(base, i):
         "M=D",
     ]
 
+def selectPointer(base, i):
+    """Points A at base[i] by stepping from the base, eg @LCL, A=M+1, A=A+1"""
+    if i == 0:
+        return [f"@{base}", "A=M"]
+    return [f"@{base}", "A=M+1"] + ["A=A+1"] * (i - 1)
+
+def setR13toPointer(base, i):
+    return [f"@{base}", "D=M", f"@{i}", "D=D+A", "@R13", "M=D"]
+
+def shortest(*candidates):
+    return min(candidates, key=len)
+
 def pointerSeg(pushpop, seg, index):
     base = SEGLABEL[seg]
     if pushpop == "push":
-        asm = setDtoPointer(base, index) + getPushD()
+        push = getPushD()
+        asm = setDtoPointer(base, index) + push
+        if OPTIONS["specialize"]:
+            asm = shortest([*selectPointer(base, index), "D=M", *push], asm)
     elif pushpop == "pop":
-        asm = getPopD() + setPointerToD(base, index)
+        pop = getPopD()
+        asm = pop + setPointerToD(base, index)
+        if OPTIONS["specialize"]:
+            # Both skip the R13/R14 round trip: walk to small offsets after
+            # the pop, or park the address in R13 before it
+            asm = shortest(
+                [*pop, *selectPointer(base, index), "M=D"],
+                [*setR13toPointer(base, index), *pop, "@R13", "A=M", "M=D"],
+            )
     return asm
 
 def fixedSeg(pushpop, seg, index):
@@ -134,9 +264,15 @@ def fixedSeg(pushpop, seg, index):
         else:
             return getPopD() + [f"@{base+index}", "M=D"]
 
+def getPushConstant(value):
+    # The ALU produces 0, 1 and -1 directly, saving the trip through D
+    if OPTIONS["specialize"] and value in (0, 1, -1):
+        return getPushValue(str(value))
+    return [f"@{value}", "D=A"] + getPushD()
+
 def constantSeg(pushpop, seg, index, vm_name):
     if seg == "constant":
-        return [f"@{index}", "D=A"] + getPushD()
+        return getPushConstant(index)
     else:
         symbol = f"{vm_name}.{index}"
         if pushpop == "push":
@@ -144,85 +280,217 @@ def constantSeg(pushpop, seg, index, vm_name):
         else:
             return getPopD() + [f"@{symbol}", "M=D"]
 
+def stackSeg(pushpop, depth):
+    """
+    Internal segment left by inlining: `push stack n` copies the word n
+    slots below the top of the stack, `pop stack n` stores into the word
+    n slots below the top once the pop is done.
+    """
+    if pushpop == "push":
+        offset = (SP_OFFSET or 0) - depth
+        push = getPushD()
+        return shortest(
+            [*stackAddress(offset), "D=M", *push],
+            ["@SP", "D=M", f"@{abs(offset)}",
+             "A=D-A" if offset < 0 else "A=D+A", "D=M", *push],
+        )
+    before = (SP_OFFSET or 0) - 1 - depth
+    pop = getPopD()
+    after = (SP_OFFSET or 0) - depth
+    return shortest(
+        [*pop, *stackAddress(after), "M=D"],
+        ["@SP", "D=M", f"@{abs(before)}", "D=D-A" if before < 0 else "D=D+A",
+         "@R13", "M=D", *pop, "@R13", "A=M", "M=D"],
+    )
+
+def getDrop(n):
+    global SP_OFFSET
+    if SP_OFFSET is not None:
+        SP_OFFSET -= n
+        return []
+    elif n <= 2:
+        return ["@SP"] + ["M=M-1"] * n
+    return [f"@{n}", "D=A", "@SP", "M=M-D"]
+
 def generateComparison(op):
     true_label = uniqueLabel()
     end_label = uniqueLabel()
     jump_cond = ARITH_TEST[op]
+    pop = getPopD()
     return [
-        *getPopD(),
-        "@SP",
-        "A=M-1",
+        *pop,
+        *stackTop(),
         "D=M-D",
         f"@{true_label}",
         f"D;{jump_cond}",
-        "@SP",
-        "A=M-1",
+        *stackTop(),
         "M=0",
         f"@{end_label}",
         "0;JMP",
         f"({true_label})",
-        "@SP",
-        "A=M-1",
+        *stackTop(),
         "M=-1",
         f"({end_label})",
     ]
 
 def uniqueLabel():
     global LABEL_NUMBER
-    label = f"LABEL_{LABEL_NUMBER}"
+    label = f"{GENERATED}{LABEL_NUMBER}"
     LABEL_NUMBER += 1
     return label
 
+def resolveLabels(asm):
+    """
+    For the in-process vm.py -> assembler pipeline, given the program
+    translate last returned: drops the definitions of the labels
+    uniqueLabel handed out and turns each reference into its ROM address.
+    Their ids run from 0 to LABEL_NUMBER, so addresses live in an array
+    and the assembler never sees these labels.
+    """
+    addresses = array("i", [-1]) * LABEL_NUMBER
+    definition = f"({GENERATED}"
+    reference = f"@{GENERATED}"
+    skip = len(reference)
+    kept = []
+    pc = 0
+    for line in asm:
+        if line.startswith(definition):
+            addresses[int(line[skip:-1])] = pc
+            continue
+        if line[0] != "(":
+            pc += 1
+        kept.append(line)
+    return [
+        f"@{addresses[int(line[skip:])]}" if line.startswith(reference) else line
+        for line in kept
+    ]
+
 def cleanLine(line):
     return line.split("//")[0].strip()
 
-def parseFile(f, vm_name):
-    out = []
-    for line in f:
+def parseIR(f, vm_name):
+    """Parses VM source lines into a vmir.VMIR."""
+    ir = vmir.VMIR(vm_name)
+    for number, line in enumerate(f, 1):
         command = cleanLine(line)
         if not command:
             continue
 
         args = command.split()
-
-        if args[0] in ARITH_BINARY:
-            out.extend(ARITH_BINARY[args[0]])
-        elif args[0] in ARITH_UNARY:
-            out.extend(ARITH_UNARY[args[0]])
-        elif args[0] in ARITH_TEST:
-            out.extend(generateComparison(args[0]))
-
-        elif args[0] in ["push", "pop"]:
-            seg_type = SEGMENTS.get(args[1], None)
-            if seg_type == "pointer":
-                out.extend(pointerSeg(args[0], args[1], int(args[2])))
-            elif seg_type == "fixed":
-                out.extend(fixedSeg(args[0], args[1], int(args[2])))
-            elif seg_type == "constant":
-                out.extend(constantSeg(args[0], args[1], int(args[2]), vm_name))
-            else:
-                raise ValueError(f"Unknown segment: {args[1]}")
-            
-        elif args[0] == "label":
-            out.extend(getLabel(args[1]))
-        elif args[0] == "goto":
-            out.extend(getGoto(args[1]))
-        elif args[0] == "if-goto":
-            out.extend(getIf_goto(args[1]))
-        elif args[0] == "function":
-            out.extend(getFunction(args[1], int(args[2])))
-        elif args[0] == "call":
-            out.extend(getCall(args[1], int(args[2])))
-        elif args[0] == "return":
-            out.extend(getReturn())
+        words = COMMAND_WORDS.get(args[0])
+        if words is not None and len(args) != words:
+            raise ValueError(
+                f"{vm_name}.vm:{number}: {args[0]} takes {words - 1} arguments, "
+                f"not {len(args) - 1}"
+            )
+        ir.append(
+            args[0],
+            args[1] if len(args) > 1 else None,
+            int(args[2]) if len(args) > 2 else None,
+            number,
+        )
+    return ir
+
+def parseCommands(f, vm_name):
+    """
+    Parses VM source lines into (op, arg1, arg2, vm_name) tuples, with the
+    numeric argument as an int. Each command remembers its file so statics
+    still resolve after optimizations move code between files.
+    """
+    return parseIR(f, vm_name).commands()
+
+def generate(command):
+    op, arg1, arg2, vm_name = command
+
+    if op in ARITH_BINARY:
+        return getBinary(op)
+    elif op in ARITH_UNARY:
+        return getUnary(op)
+    elif op in ARITH_TEST:
+        return generateComparison(op)
+
+    elif op in ["push", "pop"]:
+        seg_type = SEGMENTS.get(arg1, None)
+        if seg_type == "pointer":
+            return pointerSeg(op, arg1, arg2)
+        elif seg_type == "fixed":
+            return fixedSeg(op, arg1, arg2)
+        elif seg_type == "constant":
+            return constantSeg(op, arg1, arg2, vm_name)
+        elif seg_type == "stack":
+            return stackSeg(op, arg2)
         else:
-            raise ValueError(f"Unknown command: {args[0]}")
-
+            raise ValueError(f"Unknown segment: {arg1}")
+
+    elif op == "label":
+        return getLabel(arg1)
+    elif op == "goto":
+        return getGoto(arg1)
+    elif op == "if-goto":
+        return getIf_goto(arg1)
+    elif op == "function":
+        return getFunction(arg1, arg2)
+    elif op == "call":
+        return getCall(arg1, arg2)
+    elif op == "return":
+        return getReturn()
+    elif op == "tailcall":
+        return getTailCall(arg1, arg2)
+    elif op == "drop":
+        return getDrop(arg2)
+    else:
+        raise ValueError(f"Unknown command: {op}")
+
+def sourceLocation(vm_name):
+    line = getattr(vm_name, "line", None)
+    return f"{vm_name}.vm" if line is None else f"{vm_name}.vm:{line}"
+
+def mapInstructions(sourcemap, asm, location):
+    sourcemap.extend(location for line in asm if not line.startswith("("))
+
+def generateCommands(commands, sourcemap=None):
+    """
+    With a `sourcemap` list, appends the VM source location of every
+    instruction generated, so it can be indexed by ROM address. Batched
+    stack pointer updates belong to the commands that deferred them.
+    """
+    global SP_OFFSET
+    # A translation that raised part way may have left an offset behind
+    SP_OFFSET = None
+    out = []
+    location = None
+    for command in commands:
+        mapped = len(out)
+        op = command[0]
+        if OPTIONS["spbatch"]:
+            # D is dead between commands, so flushing here may clobber it
+            if op in BLOCK_BOUNDARIES or abs(SP_OFFSET or 0) > MAX_SP_OFFSET:
+                out.extend(flushSP())
+            if op not in BLOCK_BOUNDARIES and SP_OFFSET is None:
+                SP_OFFSET = 0
+
+        flushed = len(out)
+        out.extend(generate(command))
+        if sourcemap is not None:
+            previous, location = location, sourceLocation(command[3])
+            mapInstructions(sourcemap, out[mapped:flushed], previous or location)
+            mapInstructions(sourcemap, out[flushed:], location)
+
+    mapped = len(out)
+    out.extend(flushSP())
+    if sourcemap is not None:
+        mapInstructions(sourcemap, out[mapped:], location or "halt")
+    mapped = len(out)
     end_label = uniqueLabel()
     out.extend([f"({end_label})", f"@{end_label}", "0;JMP"])
+    if sourcemap is not None:
+        mapInstructions(sourcemap, out[mapped:], "halt")
 
     return out
 
+def parseFile(f, vm_name):
+    return generateCommands(parseCommands(f, vm_name))
+
 def getCall(function, nargs):
     return_label = uniqueLabel()
     
@@ -248,17 +516,37 @@ def getCall(function, nargs):
         *getLabel(return_label),
     ]
 
+def getTailCall(function, nargs):
+    """
+    Calls `function` in place of the current one, reusing its frame. Only
+    valid when the current function was itself called with `nargs`
+    arguments, so the saved frame already sits where the callee needs it:
+    the arguments are copied down over ours and SP reset to LCL.
+    """
+    asm = []
+    for i in range(nargs):
+        asm.extend([
+            *stackAddress(i - nargs),
+            "D=M",
+            *selectPointer("ARG", i),
+            "M=D",
+        ])
+    return [
+        *asm,
+        "@LCL",
+        "D=M",
+        "@SP",
+        "M=D",
+        *getGoto(function),
+    ]
+
 def getFunction(function, nlocal):
     asm = [
         f"({function})",  
     ]
     
     for _ in range(nlocal):
-        asm.extend([
-            "@0",
-            "D=A",
-            *getPushD(),
-        ])
+        asm.extend(getPushConstant(0))
     
     return asm
 
@@ -335,28 +623,225 @@ def getInit(sysinit=True):
         asm.extend(ext)
     return asm
 
-if __name__ == "__main__":
-    source = sys.argv[1].strip()
-    out = []
+def optimizationLevel(level):
+    return {name: name in LEVELS[level] for name in OPTIONS}
+
+def translate(sources, sysinit=True, stats=None, sourcemap=None):
+    """
+    Translates (vm_name, lines) pairs into a single Hack assembly program
+    without touching the filesystem. With a `stats` list, each stage appends
+    a (name, seconds, size before, size after) row, sizes counting VM
+    commands up to code generation and instructions after it. With a
+    `sourcemap` list, it receives a "File.vm:line" per ROM address.
+    """
+    start = time.perf_counter()
+    irs = [parseIR(lines, vm_name) for vm_name, lines in sources]
+    if stats is not None:
+        size = sum(len(ir) for ir in irs)
+        stats.append(("parse", time.perf_counter() - start, None, size))
+    return translateIR(irs, sysinit, stats, sourcemap)
+
+def translateIR(irs, sysinit=True, stats=None, sourcemap=None):
+    """Like translate, starting from parsed vmir.VMIR files."""
+    global LABEL_NUMBER, SP_OFFSET
+    if sourcemap is not None and any(OPTIONS[name] for name, _ in vmopt.ASM_PASSES):
+        raise ValueError("A source map needs the assembly passes disabled")
+    start = time.perf_counter()
+    located = sourcemap is not None
+    program = [(ir.vm_name, ir.commands(located)) for ir in irs]
+    if stats is not None:
+        size = vmopt.commandCount(program)
+        stats.append(("decode", time.perf_counter() - start, None, size))
+    program = vmopt.runPasses(
+        vmopt.VM_PASSES, OPTIONS, program, vmopt.commandCount, stats, sysinit
+    )
+
+    start = time.perf_counter()
+    SP_OFFSET = None
+    # Numbered per translation, so output does not depend on earlier ones
+    LABEL_NUMBER = 0
+    out = getInit(sysinit)
+    if sourcemap is not None:
+        mapInstructions(sourcemap, out, "bootstrap")
+    for vm_name, commands in program:
+        out.extend(generateCommands(commands, sourcemap))
+    if stats is not None:
+        size = vmopt.instructionCount(out)
+        stats.append(("codegen", time.perf_counter() - start, None, size))
+    return vmopt.runPasses(
+        vmopt.ASM_PASSES, OPTIONS, out, vmopt.instructionCount, stats
+    )
+
+def translateModules(irs, sysinit=True):
+    """
+    Translates each file into a module of its own for separate assembly,
+    after the VM passes have seen the whole program. Every module numbers
+    its generated labels from zero, so its code only changes when its
+    source does; the linker binds a module's labels locally first.
+    Returns (name, lines) pairs, the bootstrap first.
+    """
+    global LABEL_NUMBER, SP_OFFSET
+    program = [(ir.vm_name, ir.commands()) for ir in irs]
+    program = vmopt.runPasses(
+        vmopt.VM_PASSES, OPTIONS, program, vmopt.commandCount, None, sysinit
+    )
+
+    LABEL_NUMBER = 0
+    SP_OFFSET = None
+    modules = [("Bootstrap", getInit(sysinit))]
+    for vm_name, commands in program:
+        LABEL_NUMBER = 0
+        modules.append((vm_name, generateCommands(commands)))
+    return [
+        (name, vmopt.runPasses(
+            vmopt.ASM_PASSES, OPTIONS, asm, vmopt.instructionCount, None
+        ))
+        for name, asm in modules
+    ]
+
+def writeModules(modules, directory):
+    """
+    Writes each module to directory/Name.asm, leaving files whose content
+    is unchanged alone so the linker can skip them. Returns the paths.
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for name, asm in modules:
+        path = os.path.join(directory, f"{name}.asm")
+        text = "\n".join(asm) + "\n"
+        if not os.path.exists(path) or open(path).read() != text:
+            with open(path, "w") as f:
+                f.write(text)
+        paths.append(path)
+    return paths
+
+def printStats(stats, file=sys.stderr):
+    print(f"{'pass':<10} {'ms':>8} {'before':>7} {'after':>7} {'delta':>7}", file=file)
+    for name, seconds, before, after in stats:
+        if before is None:
+            sizes = f"{'':>7} {after:>7} {'':>7}"
+        else:
+            sizes = f"{before:>7} {after:>7} {after - before:>+7}"
+        print(f"{name:<10} {seconds * 1000:>8.2f} {sizes}", file=file)
+
+def sourceFiles(source):
     if os.path.isdir(source):
-        f = glob.glob(os.path.join(source, "*.vm"))
+        files = glob.glob(os.path.join(source, "*.vm"))
         sys_vm = None
-        for file_path in f:
+        for file_path in files:
             if os.path.basename(file_path) == 'Sys.vm':
                 sys_vm = file_path
                 break
         if sys_vm:
-            f.remove(sys_vm)
-            f.insert(0, sys_vm)
-        out.extend(getInit())
-        for filename in f:
-            current_vm_name = os.path.splitext(os.path.basename(filename))[0]
-            with open(filename, 'r') as f:
-                out.extend(parseFile(f, current_vm_name))
+            files.remove(sys_vm)
+            files.insert(0, sys_vm)
     else:
-        current_vm_name = os.path.splitext(os.path.basename(source))[0]
-        with open(source, 'r') as f:
-            out.extend(getInit(sysinit=False))
-            out.extend(parseFile(f, current_vm_name))
+        files = [source]
+    return files
+
+def readSources(source):
+    sources = []
+    for filename in sourceFiles(source):
+        current_vm_name = os.path.splitext(os.path.basename(filename))[0]
+        with open(filename, 'r') as f:
+            sources.append((current_vm_name, f.readlines()))
+    return sources
+
+def readIR(source, cache=True):
+    """
+    Parses each .vm file of `source`, reusing the .vmir file next to it when
+    that was built from the same source, and refreshing it when not.
+    """
+    irs = []
+    for filename in sourceFiles(source):
+        vm_name = os.path.splitext(os.path.basename(filename))[0]
+        path = os.path.splitext(filename)[0] + ".vmir"
+        stamp = vmir.sourceStamp(filename)
+        ir = vmir.load(path, vm_name, stamp) if cache else None
+        if ir is None:
+            with open(filename, 'r') as f:
+                ir = parseIR(f, vm_name)
+            if cache:
+                try:
+                    ir.save(path, stamp)
+                except OSError:
+                    pass
+        irs.append(ir)
+    return irs
+
+def main():
+    parser = argparse.ArgumentParser(description="Translate VM code to Hack assembly")
+    parser.add_argument("source", help="a .vm file or a directory of them")
+    parser.add_argument(
+        "-O", dest="level", choices=sorted(LEVELS), help="optimization preset"
+    )
+    parser.add_argument(
+        "-o",
+        "--option",
+        action="append",
+        default=[],
+        choices=sorted(OPTIONS),
+        help="option or pass to enable, after the preset",
+    )
+    parser.add_argument(
+        "--no-option",
+        action="append",
+        default=[],
+        choices=sorted(OPTIONS),
+        help="option or pass to disable, after the preset",
+    )
+    parser.add_argument(
+        "--stats", action="store_true", help="print per-pass timing and sizes to stderr"
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="neither read nor write .vmir files"
+    )
+    parser.add_argument(
+        "--modules",
+        metavar="DIR",
+        help="write one .asm per file for linker.py and print their paths",
+    )
+    parser.add_argument(
+        "--map",
+        metavar="FILE",
+        help="write the VM source location of each ROM address as JSON",
+    )
+    args = parser.parse_args()
+
+    if args.level is not None:
+        OPTIONS.update(optimizationLevel(args.level))
+    OPTIONS.update({name: True for name in args.option})
+    OPTIONS.update({name: False for name in args.no_option})
+
+    source = args.source.strip()
+    stats = [] if args.stats else None
+    start = time.perf_counter()
+    try:
+        irs = readIR(source, cache=not args.no_cache)
+    except ValueError as e:
+        parser.error(str(e))
+    if stats is not None:
+        size = sum(len(ir) for ir in irs)
+        stats.append(("load", time.perf_counter() - start, None, size))
+    if args.modules is not None:
+        try:
+            modules = translateModules(irs, sysinit=os.path.isdir(source))
+        except ValueError as e:
+            parser.error(str(e))
+        print("\n".join(writeModules(modules, args.modules)))
+        return
+    sourcemap = [] if args.map is not None else None
+    try:
+        out = translateIR(irs, os.path.isdir(source), stats, sourcemap)
+    except ValueError as e:
+        parser.error(str(e))
+    if sourcemap is not None:
+        with open(args.map, "w") as f:
+            json.dump(sourcemap, f)
+
+    print("\n".join(out))
+    if stats is not None:
+        printStats(stats)
 
-    print("\n".join(out))
\ No newline at end of file
+if __name__ == "__main__":
+    main()
\ No newline at end of file
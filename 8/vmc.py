@@ -0,0 +1,61 @@
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+
+# Kept free of the translator imports so a request costs little more than
+# interpreter startup
+SOCKET = os.path.join(tempfile.gettempdir(), f"vmd-{os.getuid()}.sock")
+
+
+def request(message, path=SOCKET):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(path)
+        client.sendall(json.dumps(message).encode() + b"\n")
+        with client.makefile("rb") as f:
+            return json.loads(f.readline())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Ask the vmd.py build server for a .hack and print its path"
+    )
+    parser.add_argument("source", nargs="?", help="a .vm file or a directory of them")
+    parser.add_argument("--output", help="where to write the .hack")
+    parser.add_argument("-O", dest="level", help="vm.py optimization preset")
+    parser.add_argument("-o", "--option", action="append", default=[])
+    parser.add_argument("--no-option", action="append", default=[])
+    parser.add_argument("--socket", default=SOCKET)
+    parser.add_argument("--stop", action="store_true", help="shut the server down")
+    args = parser.parse_args()
+    if args.source is None and not args.stop:
+        parser.error("a source is required unless --stop is given")
+
+    if args.stop:
+        message = {"command": "stop"}
+    else:
+        message = {
+            "command": "build",
+            "source": os.path.abspath(args.source),
+            "output": args.output and os.path.abspath(args.output),
+            "level": args.level,
+            "options": args.option,
+            "no_options": args.no_option,
+        }
+    try:
+        reply = request(message, args.socket)
+    except OSError as e:
+        print(f"cannot reach the server at {args.socket}: {e}", file=sys.stderr)
+        sys.exit(2)
+
+    if not reply["ok"]:
+        print(reply["error"], file=sys.stderr)
+        sys.exit(1)
+    if "path" in reply:
+        print(reply["path"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+import argparse
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "6"))
+
+from linker import assembleObject, link
+import vm
+import vmir
+from vmc import SOCKET
+
+DEFAULTS = dict(vm.OPTIONS)
+
+
+class Project:
+    """
+    One source and option set kept warm between builds: parsed files by
+    stamp and assembled objects by module text, so a rebuild reparses and
+    reassembles only what changed.
+    """
+
+    def __init__(self, source, output, options):
+        self.source = source
+        self.output = output
+        self.options = options
+        self.sysinit = os.path.isdir(source)
+        self.irs = {}
+        self.objects = {}
+        self.stamps = None
+        self.error = None
+
+    def currentStamps(self):
+        return {path: vmir.sourceStamp(path) for path in vm.sourceFiles(self.source)}
+
+    def changed(self):
+        try:
+            return self.currentStamps() != self.stamps
+        except OSError:
+            return True
+
+    def build(self):
+        """Returns how many modules had to be assembled."""
+        stamps = self.currentStamps()
+        irs = []
+        for path, stamp in stamps.items():
+            cached = self.irs.get(path)
+            if cached is None or cached[0] != stamp:
+                vm_name = os.path.splitext(os.path.basename(path))[0]
+                with open(path) as f:
+                    cached = self.irs[path] = (stamp, vm.parseIR(f, vm_name))
+            irs.append(cached[1])
+
+        saved = dict(vm.OPTIONS)
+        vm.OPTIONS.update(self.options)
+        try:
+            modules = vm.translateModules(irs, self.sysinit)
+        finally:
+            vm.OPTIONS.clear()
+            vm.OPTIONS.update(saved)
+
+        objects = []
+        rebuilt = 0
+        for name, asm in modules:
+            text = "\n".join(asm)
+            cached = self.objects.get(name)
+            if cached is None or cached[0] != text:
+                obj = assembleObject(f"{name}.asm", source=asm)
+                cached = self.objects[name] = (text, obj)
+                rebuilt += 1
+            objects.append(cached[1])
+        words, symbols = link(objects)
+
+        with open(self.output, "w") as f:
+            for word in words:
+                f.write(bin(word)[2:].zfill(16) + "\n")
+        self.stamps = stamps
+        self.error = None
+        return rebuilt
+
+
+def defaultOutput(source):
+    if os.path.isdir(source):
+        source = source.rstrip(os.sep)
+        return os.path.join(source, os.path.basename(source) + ".hack")
+    return os.path.splitext(source)[0] + ".hack"
+
+
+def buildOptions(message):
+    options = dict(DEFAULTS)
+    if message.get("level") is not None:
+        options.update(vm.optimizationLevel(message["level"]))
+    for name in message.get("options", []) + message.get("no_options", []):
+        if name not in vm.OPTIONS:
+            raise ValueError(f"Unknown option: {name}")
+    options.update({name: True for name in message.get("options", [])})
+    options.update({name: False for name in message.get("no_options", [])})
+    return options
+
+
+class BuildServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, interval, verbose=False):
+        super().__init__(path, BuildHandler)
+        self.interval = interval
+        self.verbose = verbose
+        self.projects = {}
+        # The project whose build each output path last holds: projects for
+        # different option sets may share the default output
+        self.writers = {}
+        # vm.py keeps code generation state in globals, so builds take turns
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+
+    def log(self, text):
+        if self.verbose:
+            print(text, file=sys.stderr, flush=True)
+
+    def rebuild(self, project):
+        start = time.perf_counter()
+        try:
+            rebuilt = project.build()
+        except Exception as e:
+            # A half-typed line can fail anywhere in translation; the error
+            # goes back to the client and the server keeps watching
+            project.error = str(e) or type(e).__name__
+            # Wait for the sources to change again before retrying
+            try:
+                project.stamps = project.currentStamps()
+            except OSError:
+                project.stamps = None
+            self.log(f"{project.source}: {e}")
+            return None
+        self.writers[project.output] = project
+        ms = (time.perf_counter() - start) * 1000
+        self.log(f"{project.source}: {rebuilt} modules assembled in {ms:.1f}ms")
+        return rebuilt
+
+    def stale(self, project):
+        """
+        True when the sources changed, the output is gone or another
+        project, eg other options, wrote it last.
+        """
+        return (
+            project.changed()
+            or self.writers.get(project.output) is not project
+            or not os.path.exists(project.output)
+        )
+
+    def handleBuild(self, message):
+        options = buildOptions(message)
+        source = message["source"]
+        if not os.path.exists(source):
+            return {"ok": False, "error": f"No such file or directory: {source}"}
+        output = message.get("output") or defaultOutput(source)
+        key = (source, output, tuple(sorted(options.items())))
+        with self.lock:
+            project = self.projects.get(key)
+            if project is None:
+                project = self.projects[key] = Project(source, output, options)
+            rebuilt = 0
+            if self.stale(project):
+                rebuilt = self.rebuild(project)
+            if project.error is not None:
+                return {"ok": False, "error": project.error}
+            return {"ok": True, "path": project.output, "rebuilt": rebuilt}
+
+    def watch(self):
+        """
+        Polls the sources of each project whose build its output holds,
+        rebuilding as soon as one changes. Others wait for a request, so
+        the output does not flip between option sets.
+        """
+        while not self.stopping.wait(self.interval):
+            with self.lock:
+                for project in list(self.projects.values()):
+                    try:
+                        if self.writers.get(project.output) is project and self.stale(project):
+                            self.rebuild(project)
+                    except Exception as e:
+                        self.log(f"{project.source}: {e}")
+
+
+class BuildHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server = self.server
+        try:
+            message = json.loads(self.rfile.readline())
+            if message["command"] == "build":
+                reply = server.handleBuild(message)
+            elif message["command"] == "stop":
+                reply = {"ok": True}
+                server.stopping.set()
+            else:
+                reply = {"ok": False, "error": f"Unknown command: {message['command']}"}
+        except Exception as e:
+            # Every request gets a reply, so vmc.py can report the error
+            reply = {"ok": False, "error": str(e) or type(e).__name__}
+        self.wfile.write(json.dumps(reply).encode() + b"\n")
+        self.wfile.flush()
+        if server.stopping.is_set():
+            # shutdown() waits for serve_forever, so it cannot run on this thread
+            threading.Thread(target=server.shutdown).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build server keeping vm.py and the assembler warm; see vmc.py"
+    )
+    parser.add_argument("--socket", default=SOCKET)
+    parser.add_argument(
+        "--interval", type=float, default=0.5, help="seconds between source polls"
+    )
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+    server = BuildServer(args.socket, args.interval, args.verbose)
+    threading.Thread(target=server.watch, daemon=True).start()
+    server.log(f"listening on {args.socket}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stopping.set()
+        server.server_close()
+        os.unlink(args.socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+from array import array
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "6"))
+
+from native import selectBuiltins
+from vm import cleanLine, readSources
+
+SP, LCL, ARG, THIS, THAT = range(5)
+TEMP = 5
+
+SEGPOINTER = {
+    "local": LCL,
+    "argument": ARG,
+    "this": THIS,
+    "that": THAT,
+}
+
+BINARY = {
+    "add": lambda x, y: (x + y) & 0xFFFF,
+    "sub": lambda x, y: (x - y) & 0xFFFF,
+    "and": lambda x, y: x & y,
+    "or": lambda x, y: x | y,
+}
+
+UNARY = {
+    "neg": lambda x: -x & 0xFFFF,
+    "not": lambda x: x ^ 0xFFFF,
+}
+
+COMPARE = {
+    "eq": lambda x, y: x == y,
+    "gt": lambda x, y: signed(x) > signed(y),
+    "lt": lambda x, y: signed(x) < signed(y),
+}
+
+
+def signed(value):
+    return value - 0x10000 if value & 0x8000 else value
+
+
+class VMEmulator:
+    """
+    Executes VM commands directly, keeping the same RAM layout as the code
+    generated by vm.py: the stack at 256, segment pointers in RAM[1..4] and
+    call frames saved by getCall. Return addresses are command indices.
+    """
+
+    def __init__(self, sources=None):
+        self.ram = array("H", bytes(65536))
+        self.commands = []
+        self.labels = {}
+        self.statics = {}
+        self.pc = 0
+        self.steps = 0
+        self.builtins = {}
+        self.nativeState = {}
+        if sources is not None:
+            self.load(sources)
+
+    def load(self, sources):
+        for vm_name, lines in sources:
+            for line in lines:
+                command = cleanLine(line)
+                if not command:
+                    continue
+                args = command.split()
+                if args[0] in ("label", "function"):
+                    self.labels[args[1]] = len(self.commands)
+                self.commands.append((*args, vm_name))
+
+    def boot(self):
+        """Mirrors getInit: SP=256, the other pointers -1, then call Sys.init."""
+        self.ram[SP] = 256
+        for i in (LCL, ARG, THIS, THAT):
+            self.ram[i] = 0xFFFF
+        self.pc = len(self.commands)
+        self.call("Sys.init", 0)
+
+    def push(self, value):
+        sp = self.ram[SP]
+        self.ram[sp] = value & 0xFFFF
+        self.ram[SP] = sp + 1
+
+    def pop(self):
+        sp = self.ram[SP] - 1
+        self.ram[SP] = sp
+        return self.ram[sp]
+
+    def address(self, segment, index):
+        if segment in SEGPOINTER:
+            return (self.ram[SEGPOINTER[segment]] + index) & 0xFFFF
+        elif segment == "temp":
+            return TEMP + index
+        elif segment == "pointer":
+            return THIS + index
+        raise ValueError(f"Unknown segment: {segment}")
+
+    def enableBuiltins(self, names=None):
+        """Runs the named OS functions (all by default) in Python; see native.py."""
+        self.builtins = selectBuiltins(names)
+
+    def callNative(self, function, nargs):
+        """
+        Replaces a call with its builtin, leaving what getReturn would: the
+        result where the first argument was. Returns False when there is no
+        such builtin or it declines.
+        """
+        builtin = self.builtins.get(function)
+        if builtin is None or builtin[0] != nargs:
+            return False
+        ram = self.ram
+        sp = ram[SP]
+        args = [ram[sp - nargs + i] for i in range(nargs)]
+        result = builtin[1](ram, args, self.nativeState)
+        if result is None:
+            return False
+        ram[SP] = sp - nargs
+        self.push(result)
+        return True
+
+    def call(self, function, nargs):
+        ram = self.ram
+        self.push(self.pc)
+        for pointer in (LCL, ARG, THIS, THAT):
+            self.push(ram[pointer])
+        ram[ARG] = (ram[SP] - nargs - 5) & 0xFFFF
+        ram[LCL] = ram[SP]
+        self.pc = self.labels[function]
+
+    def ret(self):
+        ram = self.ram
+        frame = ram[LCL]
+        retaddr = ram[frame - 5]
+        ram[ram[ARG]] = self.pop()
+        ram[SP] = ram[ARG] + 1
+        ram[THAT] = ram[frame - 1]
+        ram[THIS] = ram[frame - 2]
+        ram[ARG] = ram[frame - 3]
+        ram[LCL] = ram[frame - 4]
+        self.pc = retaddr
+
+    def halted(self):
+        """True when the next command is `goto` back to the label just before it."""
+        command = self.commands[self.pc] if self.pc < len(self.commands) else None
+        return (
+            command is not None
+            and command[0] == "goto"
+            and self.labels.get(command[1]) == self.pc - 1
+        )
+
+    def step(self):
+        command = self.commands[self.pc]
+        self.pc += 1
+        self.steps += 1
+        op = command[0]
+
+        if op in BINARY:
+            y = self.pop()
+            self.push(BINARY[op](self.pop(), y))
+        elif op in UNARY:
+            self.push(UNARY[op](self.pop()))
+        elif op in COMPARE:
+            y = self.pop()
+            self.push(0xFFFF if COMPARE[op](self.pop(), y) else 0)
+        elif op == "push":
+            segment, index, vm_name = command[1], int(command[2]), command[3]
+            if segment == "constant":
+                self.push(index)
+            elif segment == "static":
+                self.push(self.statics.get(f"{vm_name}.{index}", 0))
+            else:
+                self.push(self.ram[self.address(segment, index)])
+        elif op == "pop":
+            segment, index, vm_name = command[1], int(command[2]), command[3]
+            value = self.pop()
+            if segment == "static":
+                self.statics[f"{vm_name}.{index}"] = value
+            else:
+                self.ram[self.address(segment, index)] = value
+        elif op == "label":
+            pass
+        elif op == "goto":
+            self.pc = self.labels[command[1]]
+        elif op == "if-goto":
+            if self.pop():
+                self.pc = self.labels[command[1]]
+        elif op == "function":
+            for _ in range(int(command[2])):
+                self.push(0)
+        elif op == "call":
+            if not self.callNative(command[1], int(command[2])):
+                self.call(command[1], int(command[2]))
+        elif op == "return":
+            self.ret()
+        else:
+            raise ValueError(f"Unknown command: {op}")
+
+    def run(self, steps):
+        """Runs until the program halts or `steps` commands have executed."""
+        n = 0
+        while n < steps and not self.halted():
+            self.step()
+            n += 1
+        return n
+
+
+if __name__ == "__main__":
+    emulator = VMEmulator(readSources(sys.argv[1].strip()))
+    emulator.boot()
+    emulator.run(int(sys.argv[2]) if len(sys.argv) > 2 else 100000)
+    print(f"{emulator.steps} steps")
+    for i in range(5):
+        print(f"RAM[{i}] = {signed(emulator.ram[i])}")
+    for symbol, value in sorted(emulator.statics.items()):
+        print(f"{symbol} = {signed(value)}")
@@ -0,0 +1,137 @@
+"""
+Compact VM intermediate representation: one opcode byte per command, two
+int operands, the source line and a table of interned strings for
+segments, labels and function names. A .vmir file holds one translated
+.vm file and is read back through mmap without copying.
+"""
+
+from array import array
+import mmap
+import os
+import struct
+
+OPCODES = [
+    "add", "sub", "neg", "eq", "gt", "lt", "and", "or", "not",
+    "push", "pop", "label", "goto", "if-goto",
+    "function", "call", "return", "tailcall", "drop",
+]
+OPCODE = {op: i for i, op in enumerate(OPCODES)}
+
+# Operand value for a missing argument
+NONE = -0x80000000
+
+MAGIC = b"VMIR"
+VERSION = 2
+# magic, version, source mtime_ns and size, commands, string table bytes
+HEADER = struct.Struct("=4sHqqII")
+
+
+class SourceName(str):
+    """A command's vm_name that also remembers the source line it came from."""
+
+    def __new__(cls, vm_name, line):
+        name = super().__new__(cls, vm_name)
+        name.line = line
+        return name
+
+
+class VMIR:
+    def __init__(
+        self, vm_name, ops=None, arg1=None, arg2=None, strings=None, lines=None
+    ):
+        self.vm_name = vm_name
+        self.ops = bytearray() if ops is None else ops
+        self.arg1 = array("i") if arg1 is None else arg1
+        self.arg2 = array("i") if arg2 is None else arg2
+        self.lines = array("i") if lines is None else lines
+        self.strings = [] if strings is None else strings
+        self.ids = {s: i for i, s in enumerate(self.strings)}
+
+    def __len__(self):
+        return len(self.ops)
+
+    def intern(self, s):
+        if s not in self.ids:
+            self.ids[s] = len(self.strings)
+            self.strings.append(s)
+        return self.ids[s]
+
+    def append(self, op, arg1=None, arg2=None, line=0):
+        if op not in OPCODE:
+            raise ValueError(f"Unknown command: {op}")
+        self.ops.append(OPCODE[op])
+        self.arg1.append(NONE if arg1 is None else self.intern(arg1))
+        self.arg2.append(NONE if arg2 is None else arg2)
+        self.lines.append(line)
+
+    def commands(self, located=False):
+        """
+        Decodes into the (op, arg1, arg2, vm_name) tuples vm.py generates
+        from. When located, each vm_name is a SourceName carrying the line.
+        """
+        strings = self.strings
+        if located:
+            names = [SourceName(self.vm_name, line) for line in self.lines]
+        else:
+            names = [self.vm_name] * len(self.ops)
+        return [
+            (
+                OPCODES[op],
+                None if a1 == NONE else strings[a1],
+                None if a2 == NONE else a2,
+                vm_name,
+            )
+            for op, a1, a2, vm_name in zip(self.ops, self.arg1, self.arg2, names)
+        ]
+
+    def save(self, path, stamp=(0, 0)):
+        table = "\0".join(self.strings).encode()
+        with open(path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, *stamp, len(self.ops), len(table)))
+            f.write(self.ops)
+            f.write(self.arg1.tobytes())
+            f.write(self.arg2.tobytes())
+            f.write(self.lines.tobytes())
+            f.write(table)
+
+
+def load(path, vm_name, stamp=None):
+    """
+    Maps a .vmir file, returning None when it is missing, from another
+    version or, given a stamp, built from a different source.
+    """
+    try:
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    if len(mm) < HEADER.size:
+        return None
+
+    magic, version, mtime, size, n, tablesize = HEADER.unpack_from(mm)
+    if magic != MAGIC or version != VERSION:
+        return None
+    if stamp is not None and (mtime, size) != tuple(stamp):
+        return None
+    if len(mm) != HEADER.size + 13 * n + tablesize:
+        return None
+
+    # The operand arrays are views into the mapping, not copies
+    view = memoryview(mm)
+    offset = HEADER.size
+    ops = view[offset : offset + n]
+    offset += n
+    arg1 = view[offset : offset + 4 * n].cast("i")
+    offset += 4 * n
+    arg2 = view[offset : offset + 4 * n].cast("i")
+    offset += 4 * n
+    lines = view[offset : offset + 4 * n].cast("i")
+    offset += 4 * n
+    table = bytes(view[offset : offset + tablesize]).decode()
+    strings = table.split("\0") if table else []
+    return VMIR(vm_name, ops, arg1, arg2, strings, lines)
+
+
+def sourceStamp(path):
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
@@ -0,0 +1,356 @@
+"""
+Optimization passes for vm.py. VM passes take a program, a list of
+(vm_name, commands) pairs where each command is an (op, arg1, arg2,
+vm_name) tuple from vm.parseCommands. Assembly passes take the generated
+list of Hack assembly lines.
+"""
+
+import time
+
+# Largest function body, in VM commands, that gets expanded at call sites
+INLINE_BUDGET = 24
+
+STACK_EFFECT = {
+    "add": -1, "sub": -1, "and": -1, "or": -1,
+    "eq": -1, "gt": -1, "lt": -1,
+    "neg": 0, "not": 0,
+    "push": 1, "pop": -1,
+    "label": 0, "if-goto": -1,
+}
+
+
+def splitFunctions(commands):
+    """Yields (name, nlocals, body) for each function in a file's commands."""
+    name = None
+    for i, command in enumerate(commands):
+        if command[0] == "function":
+            if name is not None:
+                yield name, nlocals, commands[start:i]
+            name, nlocals, start = command[1], command[2], i + 1
+    if name is not None:
+        yield name, nlocals, commands[start:]
+
+
+def stackDepths(body):
+    """
+    Returns the stack depth before each command of a function body, counted
+    from just after its locals, or None when some depth is not statically
+    known (unreachable code, or labels reached with different depths).
+    """
+    labels = {}
+
+    def join(label, depth):
+        return labels.setdefault(label, depth) == depth
+
+    # A second sweep picks up labels that are only reached by jumping back
+    for _ in range(2):
+        depths = []
+        d = 0
+        for op, arg1, arg2, _ in body:
+            if op == "label" and d is None:
+                d = labels.get(arg1)
+            elif op == "label" and not join(arg1, d):
+                return None
+            depths.append(d)
+            if d is None:
+                continue
+
+            if op == "call":
+                d += 1 - arg2
+            elif op == "goto":
+                if not join(arg1, d):
+                    return None
+                d = None
+            elif op == "return":
+                d = None
+            elif op in STACK_EFFECT:
+                d += STACK_EFFECT[op]
+                if op == "if-goto" and not join(arg1, d):
+                    return None
+            else:
+                return None
+            if d is not None and d < 0:
+                return None
+        if None not in depths:
+            return depths
+    return None
+
+
+def inlinable(nlocals, body):
+    if len(body) > INLINE_BUDGET:
+        return None
+    for op, arg1, arg2, _ in body:
+        # A real return would restore THIS and THAT; inlined code cannot
+        if op == "pop" and arg1 == "pointer":
+            return None
+    return stackDepths(body)
+
+
+def expand(name, nlocals, body, depths, nargs, site):
+    """
+    Returns the commands for an inlined call. Arguments and locals become
+    slots on the caller's stack, addressed relative to the top of the stack
+    through the internal `stack` segment, and each return moves the result
+    down to where the first argument was.
+    """
+    k = nlocals
+    vm_name = body[0][3] if body else None
+    end = f"{name}$inline{site}$end"
+    out = [("push", "constant", 0, vm_name)] * k
+    for i, (command, d) in enumerate(zip(body, depths)):
+        op, arg1, arg2, vm_name = command
+        if op in ("push", "pop") and arg1 in ("argument", "local"):
+            slot = arg2 if arg1 == "argument" else nargs + arg2
+            depth = nargs + k + d - slot - (op == "pop")
+            out.append((op, "stack", depth, vm_name))
+        elif op in ("label", "goto", "if-goto"):
+            out.append((op, f"{arg1}$inline{site}", arg2, vm_name))
+        elif op == "return":
+            total = nargs + k + d
+            if total > 1:
+                out.append(("pop", "stack", total - 1, vm_name))
+            if total > 2:
+                out.append(("drop", None, total - 2, vm_name))
+            if i != len(body) - 1:
+                out.append(("goto", end, None, vm_name))
+        else:
+            out.append(command)
+    out.append(("label", end, None, vm_name))
+    return out
+
+
+def maxIndex(body, segment):
+    return max(
+        (arg2 + 1 for op, arg1, arg2, _ in body
+         if op in ("push", "pop") and arg1 == segment),
+        default=0,
+    )
+
+
+def inline(program, sysinit=True):
+    """
+    Expands calls to functions of at most INLINE_BUDGET commands, one level
+    deep: expansions use the original bodies, so a recursive function is
+    unrolled once rather than forever. With a bootstrap, functions left
+    without callers are dropped.
+    """
+    candidates = {}
+    for vm_name, commands in program:
+        for name, nlocals, body in splitFunctions(commands):
+            depths = inlinable(nlocals, body)
+            if depths is not None:
+                candidates[name] = (nlocals, body, depths)
+
+    site = 0
+    result = []
+    for vm_name, commands in program:
+        out = []
+        for command in commands:
+            op, name, nargs, _ = command
+            info = candidates.get(name) if op == "call" else None
+            if info is not None and maxIndex(info[1], "argument") <= nargs:
+                out.extend(expand(name, *info, nargs, site))
+                site += 1
+            else:
+                out.append(command)
+        result.append((vm_name, out))
+
+    if sysinit:
+        result = removeUnused(result)
+    return result
+
+
+def removeUnused(program):
+    called = {"Sys.init"}
+    for vm_name, commands in program:
+        for op, arg1, arg2, _ in commands:
+            if op in ("call", "tailcall"):
+                called.add(arg1)
+
+    result = []
+    for vm_name, commands in program:
+        out = []
+        keep = True
+        for command in commands:
+            if command[0] == "function":
+                keep = command[1] in called
+            if keep:
+                out.append(command)
+        result.append((vm_name, out))
+    return result
+
+
+def callArity(program, sysinit):
+    arity = {"Sys.init": {0}} if sysinit else {}
+    for vm_name, commands in program:
+        for op, arg1, arg2, _ in commands:
+            if op == "call":
+                arity.setdefault(arg1, set()).add(arg2)
+    return arity
+
+
+def tailcalls(program, sysinit=True):
+    """
+    Rewrites `call f n; return` into a frame-reusing tail call when every
+    call of the enclosing function passes n arguments too, so its saved
+    frame is already where f's frame has to be.
+    """
+    arity = callArity(program, sysinit)
+    result = []
+    for vm_name, commands in program:
+        out = []
+        current = None
+        skip = False
+        for i, command in enumerate(commands):
+            op, arg1, arg2, name = command
+            if skip:
+                skip = False
+                continue
+            if op == "function":
+                current = arg1
+            following = commands[i + 1] if i + 1 < len(commands) else None
+            if (
+                op == "call"
+                and following is not None
+                and following[0] == "return"
+                and arity.get(current) == {arg2}
+            ):
+                out.append(("tailcall", arg1, arg2, name))
+                skip = True
+            else:
+                out.append(command)
+        result.append((vm_name, out))
+    return result
+
+
+def isLabel(line):
+    return line.startswith("(")
+
+
+def isUnconditional(line):
+    return line.endswith(";JMP") and "=" not in line
+
+
+def removeDeadCode(asm):
+    """Drops instructions after an unconditional jump up to the next label."""
+    out = []
+    dead = False
+    for line in asm:
+        if isLabel(line):
+            dead = False
+        if not dead:
+            out.append(line)
+        if isUnconditional(line):
+            dead = True
+    return out
+
+
+def threadJumps(asm):
+    """
+    Retargets jumps whose destination is itself `@L 0;JMP` straight to L,
+    then drops jumps to the instruction that follows anyway.
+    """
+    targets = {}
+    pending = []
+    for i, line in enumerate(asm):
+        if isLabel(line):
+            pending.append(line[1:-1])
+        else:
+            for label in pending:
+                targets[label] = i
+            pending = []
+
+    def final(label):
+        seen = set()
+        while label not in seen:
+            seen.add(label)
+            i = targets.get(label)
+            if i is None or i + 1 == len(asm) or not isUnconditional(asm[i + 1]):
+                break
+            if not asm[i].startswith("@"):
+                break
+            label = asm[i][1:]
+        return label
+
+    out = []
+    i = 0
+    while i < len(asm):
+        line = asm[i]
+        following = asm[i + 1] if i + 1 < len(asm) else ""
+        if line.startswith("@") and ";J" in following:
+            label = final(line[1:])
+            # Without a dest the jump has no side effects, so jumping to the
+            # next instruction is the same as falling through
+            j = i + 2
+            while j < len(asm) and isLabel(asm[j]) and asm[j] != f"({label})":
+                j += 1
+            if "=" not in following and j < len(asm) and asm[j] == f"({label})":
+                i += 2
+                continue
+            line = f"@{label}"
+        out.append(line)
+        i += 1
+    return out
+
+
+def rewriteTail(out):
+    """Applies one peephole rule to the end of `out`, returning whether it did."""
+    if len(out) >= 2 and out[-2].startswith("@") and out[-1].startswith("@"):
+        # The first load is overwritten before anything reads it
+        del out[-2]
+        return True
+    if out[-4:] == ["@SP", "M=M+1", "@SP", "AM=M-1"]:
+        # A push straight into a pop: SP ends where it was, A at the slot
+        out[-4:] = ["@SP", "A=M"]
+        return True
+    if out[-2:] == ["M=D", "D=M"]:
+        out.pop()
+        return True
+    return False
+
+
+def peephole(asm):
+    """Rewrites adjacent instructions; labels break every pattern."""
+    out = []
+    for line in asm:
+        out.append(line)
+        while rewriteTail(out):
+            pass
+    return out
+
+
+def commandCount(program):
+    return sum(len(commands) for vm_name, commands in program)
+
+
+def instructionCount(asm):
+    return sum(not isLabel(line) for line in asm)
+
+
+# Pipelines in the order they run; each name is also a vm.OPTIONS flag
+VM_PASSES = [
+    ("inline", inline),
+    ("tailcall", tailcalls),
+]
+
+ASM_PASSES = [
+    ("deadcode", removeDeadCode),
+    ("jumps", threadJumps),
+    ("peephole", peephole),
+]
+
+
+def runPasses(passes, options, ir, size, stats, *args):
+    """
+    Runs the enabled passes over `ir`. When `stats` is a list, appends a
+    (name, seconds, size before, size after) row per pass.
+    """
+    for name, run in passes:
+        if not options[name]:
+            continue
+        before = size(ir)
+        start = time.perf_counter()
+        ir = run(ir, *args)
+        if stats is not None:
+            stats.append((name, time.perf_counter() - start, before, size(ir)))
+    return ir